@@ -0,0 +1,22 @@
+from src.batch import load_manifest, extract_batch, extract_batch_parallel
+import argparse, os
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract many enemies/spritemap sets from a ROM to project JSON files, without the GUI.')
+    parser.add_argument('rom', help='SNES ROM file')
+    parser.add_argument('manifest', help='JSON list of the items to extract, see src/batch.py')
+    parser.add_argument('-o', '--output', default='.', help='folder to put the project files in')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes, 0 for one per CPU core')
+    parser.add_argument('--asm', action='store_true', help='also export the ASM, GFX and PAL files')
+    parser.add_argument('--asm-combined', action='store_true', help='also export single ASM files with the GFX and palette in them')
+    parser.add_argument('--png', action='store_true', help='also export the PNG files')
+    parser.add_argument('--atlas', action='store_true', help='also export the frames packed in PNG atlases, with a JSON file of where each frame is')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    jobs = load_manifest(args.manifest)
+    exports = [name for name, enabled in (('asm', args.asm), ('asm_combined', args.asm_combined), ('png', args.png), ('atlas', args.atlas)) if enabled]
+    if args.jobs == 1:
+        extract_batch(args.rom, jobs, args.output, exports)
+    else:
+        extract_batch_parallel(args.rom, jobs, args.output, exports, args.jobs or None)
@@ -0,0 +1,231 @@
+from PySide6.QtCore import Qt, QElapsedTimer, QRectF, QTimer, Slot
+from PySide6.QtGui import QPixmap, QTransform
+from PySide6.QtWidgets import *
+from src.gfx import TileCache, clear_out_of_palette, indexed_image_from_buffer
+from src.extract_export import export_palettes, render_spritemap, render_ext_spritemap, spritemaps_by_name, build_atlas
+from bisect import bisect_right
+from collections import deque
+import base64, time
+
+FPS = 60
+HUD_INTERVAL = 0.25 # seconds between HUD updates while playing
+
+class AtlasFrameItem(QGraphicsItem):
+    '''Draws one frame of an atlas pixmap, at its origin'''
+
+    def __init__(self):
+        super().__init__()
+        self.atlas = QPixmap()
+        self.frames = []
+        self.frame = None
+        self.rect = QRectF()
+
+    def setAtlas(self, atlas, frames):
+        '''frames: (x, y, width, height, origin x, origin y) in the atlas'''
+        self.prepareGeometryChange()
+        self.atlas = atlas
+        self.frames = frames
+        self.frame = None
+
+        # big enough for every frame, so it doesn't change while playing
+        self.rect = QRectF()
+        for x, y, width, height, originX, originY in frames:
+            self.rect = self.rect.united(QRectF(-originX, -originY, width, height))
+        self.update()
+
+    def setFrame(self, frame):
+        if frame != self.frame:
+            self.frame = frame
+            self.update()
+
+    def boundingRect(self):
+        return self.rect
+
+    def paint(self, painter, option, widget=None):
+        if self.frame != None:
+            (x, y, width, height, originX, originY) = self.frames[self.frame]
+            painter.drawPixmap(QRectF(-originX, -originY, width, height), self.atlas, QRectF(x, y, width, height))
+
+class AnimationPlayer(QDialog):
+    '''Plays a list of spritemaps and extended spritemaps, each shown for a number of frames at 60 FPS
+
+    The frames are rendered once into an atlas before playing, and a HUD shows what rendering
+    cost and whether the timer keeps up.
+    '''
+
+    def __init__(self, parent, data):
+        super().__init__(parent)
+        self.setWindowTitle('Animation')
+        self.data = data
+
+        self.sourceList = QListWidget(self)
+        self.sourceList.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        for spritemap in data['spritemaps']:
+            item = QListWidgetItem(spritemap['name'], self.sourceList)
+            item.setData(Qt.UserRole, ('spritemap', spritemap['name']))
+        for ext_spritemap in data['ext_spritemaps']:
+            item = QListWidgetItem(ext_spritemap['name']+' (extended)', self.sourceList)
+            item.setData(Qt.UserRole, ('ext_spritemap', ext_spritemap['name']))
+
+        self.durationSpinBox = QSpinBox(self)
+        self.durationSpinBox.setRange(1, 0xFFFF)
+        self.durationSpinBox.setValue(8)
+        self.durationSpinBox.setSuffix(' frames')
+        addButton = QPushButton('Add')
+        addButton.clicked.connect(self.addClicked)
+        addRow = QHBoxLayout()
+        addRow.addWidget(self.durationSpinBox)
+        addRow.addWidget(addButton)
+
+        self.frameList = QListWidget(self)
+        removeButton = QPushButton('Remove')
+        removeButton.clicked.connect(self.removeClicked)
+        self.playButton = QPushButton('Play')
+        self.playButton.setCheckable(True)
+        self.playButton.toggled.connect(self.playToggled)
+        frameListRow = QHBoxLayout()
+        frameListRow.addWidget(removeButton)
+        frameListRow.addWidget(self.playButton)
+
+        left = QVBoxLayout()
+        left.addWidget(QLabel('Spritemaps'))
+        left.addWidget(self.sourceList)
+        left.addLayout(addRow)
+        left.addWidget(QLabel('Animation'))
+        left.addWidget(self.frameList)
+        left.addLayout(frameListRow)
+
+        self.scene = QGraphicsScene(self)
+        self.frameItem = AtlasFrameItem()
+        self.scene.addItem(self.frameItem)
+        self.view = QGraphicsView(self.scene)
+        self.view.setSceneRect(-128, -128, 256, 256)
+        self.view.setTransform(QTransform(2, 0, 0, 2, 0, 0))
+        self.hud = QLabel(self)
+        self.hud.setTextInteractionFlags(Qt.TextSelectableByMouse)
+
+        right = QVBoxLayout()
+        right.addWidget(self.view)
+        right.addWidget(self.hud)
+
+        layout = QHBoxLayout(self)
+        layout.addLayout(left)
+        layout.addLayout(right)
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setInterval(1000//FPS)
+        self.timer.timeout.connect(self.tick)
+        self.clock = QElapsedTimer()
+        self.atlasKeys = None
+
+    @Slot()
+    def addClicked(self):
+        for source in self.sourceList.selectedItems():
+            item = QListWidgetItem(f'{source.text()} x{self.durationSpinBox.value()}', self.frameList)
+            item.setData(Qt.UserRole, (source.data(Qt.UserRole), self.durationSpinBox.value()))
+
+    @Slot()
+    def removeClicked(self):
+        for item in self.frameList.selectedItems():
+            self.frameList.takeItem(self.frameList.row(item))
+
+    def prerender(self, keys):
+        '''Renders every different frame once into the atlas'''
+        start = time.perf_counter()
+        tiles = TileCache(base64.b64decode(bytes(self.data['gfx'], 'utf8')))
+        byName = spritemaps_by_name(self.data)
+        extByName = {}
+        for ext_spritemap in self.data['ext_spritemaps']:
+            extByName.setdefault(ext_spritemap['name'], ext_spritemap)
+
+        canvases = []
+        self.renderCosts = []
+        for kind, name in keys:
+            frameStart = time.perf_counter()
+            if kind == 'spritemap':
+                canvases.append(render_spritemap(self.data, tiles, byName[name]))
+            else:
+                canvases.append(render_ext_spritemap(self.data, tiles, extByName[name], byName))
+            self.renderCosts.append(time.perf_counter()-frameStart)
+
+        (buffer, frames) = build_atlas(canvases)
+        if buffer.size > 0:
+            palettes = export_palettes(self.data)
+            clear_out_of_palette(buffer, palettes)
+            atlas = QPixmap.fromImage(indexed_image_from_buffer(buffer, palettes))
+        else:
+            atlas = QPixmap()
+        self.frameItem.setAtlas(atlas, frames)
+
+        self.atlasKeys = keys
+        self.atlasSize = (buffer.shape[1], buffer.shape[0])
+        self.prerenderCost = time.perf_counter()-start
+
+    @Slot(bool)
+    def playToggled(self, checked):
+        if not checked:
+            self.timer.stop()
+            self.playButton.setText('Play')
+            return
+
+        sequence = [self.frameList.item(i).data(Qt.UserRole) for i in range(self.frameList.count())]
+        if len(sequence) == 0:
+            self.playButton.setChecked(False)
+            return
+
+        keys = list(dict.fromkeys(key for key, duration in sequence))
+        if keys != self.atlasKeys:
+            self.prerender(keys)
+        self.sequence = [keys.index(key) for key, duration in sequence]
+        self.ends = []
+        for key, duration in sequence:
+            self.ends.append((self.ends[-1] if len(self.ends) > 0 else 0) + duration)
+        for i in range(self.frameList.count()):
+            index = self.sequence[i]
+            self.frameList.item(i).setToolTip(f'Render cost: {self.renderCosts[index]*1000:.2f} ms')
+
+        self.lastTick = None
+        self.lastTickTime = None
+        self.lastHUDTime = None
+        self.dropped = 0
+        self.intervals = deque(maxlen=FPS) # the last second
+        self.tickCost = 0
+        self.playButton.setText('Stop')
+        self.clock.start()
+        self.tick()
+        self.timer.start()
+
+    @Slot()
+    def tick(self):
+        start = time.perf_counter()
+        tick = self.clock.elapsed()*FPS//1000
+        if tick == self.lastTick:
+            return # the timer fired early
+        if self.lastTick != None:
+            self.dropped += tick-self.lastTick-1
+            self.intervals.append(start-self.lastTickTime)
+        self.lastTick = tick
+        self.lastTickTime = start
+
+        self.frameItem.setFrame(self.sequence[bisect_right(self.ends, tick % self.ends[-1])])
+
+        self.tickCost = max(self.tickCost, time.perf_counter()-start)
+        if self.lastHUDTime == None or start-self.lastHUDTime >= HUD_INTERVAL:
+            self.lastHUDTime = start
+            self.updateHUD()
+
+    def updateHUD(self):
+        heaviest = max(range(len(self.atlasKeys)), key=lambda i: self.renderCosts[i])
+        lines = [
+            f'Pre-render: {self.prerenderCost*1000:.1f} ms for {len(self.atlasKeys)} frames, atlas {self.atlasSize[0]}x{self.atlasSize[1]}',
+            f'Heaviest frame: {self.atlasKeys[heaviest][1]} ({self.renderCosts[heaviest]*1000:.2f} ms)'
+        ]
+        if len(self.intervals) > 0:
+            lines.append(f'Frame time: {sum(self.intervals)/len(self.intervals)*1000:.1f} ms avg, {max(self.intervals)*1000:.1f} ms max (budget {1000/FPS:.1f} ms)')
+        lines.append(f'Update cost: {self.tickCost*1000:.2f} ms max, dropped frames: {self.dropped}')
+        self.hud.setText('\n'.join(lines))
+
+    def done(self, result):
+        self.timer.stop()
+        super().done(result)
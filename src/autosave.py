@@ -0,0 +1,130 @@
+from PySide6.QtCore import QRunnable
+from src.project_file import load_project
+import copy, json, os, time
+
+''' Autosave journal
+
+While a project is edited, only the parts that changed since the last autosave get appended to
+<project file>.journal, one JSON record per line. Saving the project normally writes the whole file
+and deletes the journal. If the journal is still there when the project is opened again, the editor
+probably crashed, and replaying it on top of the project file gives back the unsaved work.
+
+A record can have these keys, each one only if that part changed:
+spritemaps: the changed spritemaps by ID, the ID of a spritemap of the project file is its index
+order: the IDs of all the spritemaps, in order (spritemaps were added, removed or moved)
+ext_hitboxes, ext_spritemaps, gfx, palette: the whole part
+meta: the other keys of the project (name, offsets...)
+'''
+
+JOURNAL_EXTENSION = '.journal'
+SECTIONS = ('order', 'ext_hitboxes', 'ext_spritemaps', 'gfx', 'palette', 'meta')
+_NOT_META = ('spritemaps', 'ext_hitboxes', 'ext_spritemaps', 'gfx', 'palette')
+
+def journal_path(fp):
+    return fp + JOURNAL_EXTENSION
+
+def has_journal(fp):
+    return os.path.exists(journal_path(fp))
+
+def discard_journal(fp):
+    if has_journal(fp):
+        os.remove(journal_path(fp))
+
+class DirtyTracker:
+    '''Keeps track of what changed since the last autosave'''
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.sections = set()
+        self.spritemaps = set()
+
+    def mark(self, section):
+        assert section in SECTIONS, f'unknown section {section}'
+        self.sections.add(section)
+
+    def mark_spritemap(self, uid):
+        self.spritemaps.add(uid)
+
+    def mark_all(self, uids):
+        self.sections.update(SECTIONS)
+        self.spritemaps.update(uids)
+
+    def __bool__(self):
+        return len(self.sections) > 0 or len(self.spritemaps) > 0
+
+    def take_record(self, data, order, get_spritemap):
+        '''Returns the journal record of the dirty parts of data and clears them
+
+        order is the IDs of the spritemaps, get_spritemap(uid) returns one of them.
+        The record is a copy, so it can be written while the project keeps being edited.
+        '''
+        record = {'time': time.time()}
+        if len(self.spritemaps) > 0:
+            record['spritemaps'] = {uid: get_spritemap(uid) for uid in order if uid in self.spritemaps}
+        if 'order' in self.sections:
+            record['order'] = list(order)
+        for section in ('ext_hitboxes', 'ext_spritemaps', 'gfx', 'palette'):
+            if section in self.sections:
+                record[section] = data[section]
+        if 'meta' in self.sections:
+            record['meta'] = {key: value for key, value in data.items() if key not in _NOT_META}
+        self.clear()
+        return copy.deepcopy(record)
+
+def append_journal(fp, record):
+    with open(journal_path(fp), 'a') as file:
+        file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+def rewrite_journal(fp, record):
+    '''Replaces the journal with record, without a moment where neither exists'''
+    temp_path = journal_path(fp) + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, journal_path(fp))
+
+class JournalWriter(QRunnable):
+    '''Appends a record to the journal off the GUI thread, or replaces the journal with it'''
+    def __init__(self, fp, record, replace=False):
+        super().__init__()
+        self.fp = fp
+        self.record = record
+        self.replace = replace
+
+    def run(self):
+        if self.replace:
+            rewrite_journal(self.fp, self.record)
+        else:
+            append_journal(self.fp, self.record)
+
+def read_journal(fp):
+    records = []
+    with open(journal_path(fp), 'r') as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break # the last record was cut off by the crash
+    return records
+
+def recover(fp):
+    '''Returns the project file with its journal replayed on top'''
+    data = load_project(fp)
+    spritemaps = {str(i): spritemap for i, spritemap in enumerate(data['spritemaps'])}
+    order = list(spritemaps.keys())
+
+    for record in read_journal(fp):
+        spritemaps.update(record.get('spritemaps', {}))
+        order = record.get('order', order)
+        for section in ('ext_hitboxes', 'ext_spritemaps', 'gfx', 'palette'):
+            if section in record:
+                data[section] = record[section]
+        data.update(record.get('meta', {}))
+
+    data['spritemaps'] = [spritemaps[uid] for uid in order]
+    return data
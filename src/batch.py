@@ -0,0 +1,141 @@
+from src.extract_export import extract_generic, extract_enemy, export_to_asm, export_to_png, export_to_png_atlas
+from src.romhandler import RomHandlerParent
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.util import Finalize
+import json, os, time, traceback
+
+''' Extraction of many enemies/spritemap sets from one ROM, without the GUI
+
+A manifest is a JSON list of jobs. Enemy jobs look like
+    {"name": "Boyon", "enemy_id": "0xCEBF", "spritemaps": ["0xA288DA", null]}
+and generic jobs like
+    {"name": "Thing", "gfx_addr": "0x9AB200", "gfx_size": "0x20", "pal_addr": "0xA2A000", "spritemaps": ["0xA28000", null]}
+with these optional keys:
+    "ext_hitboxes", "ext_spritemaps": [start, end], start null to skip them (the default)
+    "gfx_offset" (0), "compressed_gfx" (false), "pal_count" (1), "pal_offset" (0) for generic jobs
+Range ends can be null to autodetect them, like in the import dialog.
+Numbers are either integers or hex strings.
+'''
+
+def parse_number(value):
+    if value == None or isinstance(value, int):
+        return value
+    return int(value, 16)
+
+def parse_range(value):
+    if value == None:
+        return (None, None)
+    return (parse_number(value[0]), parse_number(value[1]))
+
+def load_manifest(fp):
+    with open(fp, 'r') as file:
+        return json.load(file)
+
+def run_job(rom, job):
+    '''Extracts the project data for a manifest entry'''
+    spritemap_range = parse_range(job['spritemaps'])
+    ext_hitbox_range = parse_range(job.get('ext_hitboxes'))
+    ext_spritemap_range = parse_range(job.get('ext_spritemaps'))
+
+    if 'enemy_id' in job:
+        return extract_enemy(rom, parse_number(job['enemy_id']), spritemap_range, ext_hitbox_range, ext_spritemap_range, job['name'])
+    return extract_generic(rom,
+        parse_number(job['gfx_addr']), parse_number(job['gfx_size']), parse_number(job.get('gfx_offset', 0)),
+        parse_number(job['pal_addr']), parse_number(job.get('pal_count', 1)), parse_number(job.get('pal_offset', 0)),
+        spritemap_range, ext_hitbox_range, ext_spritemap_range, job['name'], job.get('compressed_gfx', False))
+
+def save_project(data, folder_name):
+    with open(os.path.join(folder_name, data['name']+'.json'), 'w') as file:
+        json.dump(data, file, indent=1)
+
+def process_job(rom, job, folder_name, exports=()):
+    '''Extracts a job, saves it and runs the exports ('asm', 'asm_combined', 'png' and/or 'atlas') on it
+
+    Returns a summary of the job. Errors are caught and returned in it, so that a bad job doesn't stop the others.
+    '''
+    start = time.perf_counter()
+    result = {'name': job.get('name'), 'spritemaps': 0, 'ext_hitboxes': 0, 'ext_spritemaps': 0, 'error': None}
+    try:
+        data = run_job(rom, job)
+        save_project(data, folder_name)
+        if 'asm' in exports:
+            export_to_asm(data, folder_name)
+        if 'asm_combined' in exports:
+            export_to_asm(data, folder_name, combined=True)
+        if 'png' in exports:
+            export_to_png(data, folder_name)
+        if 'atlas' in exports:
+            export_to_png_atlas(data, folder_name)
+
+        result['spritemaps'] = len(data['spritemaps'])
+        result['ext_hitboxes'] = len(data['ext_hitboxes'])
+        result['ext_spritemaps'] = len(data['ext_spritemaps'])
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['time'] = time.perf_counter() - start
+    return result
+
+def report_result(result, report, prefix=''):
+    if result['error'] != None:
+        report(f'{prefix}{result["name"]}: failed in {result["time"]*1000:.1f} ms\n{result["error"]}')
+    else:
+        report(f'{prefix}{result["name"]}: {result["spritemaps"]} spritemaps, {result["ext_hitboxes"]} hitboxes, '
+               f'{result["ext_spritemaps"]} extended spritemaps in {result["time"]*1000:.1f} ms')
+
+def report_summary(results, elapsed, report):
+    spritemap_count = sum(result['spritemaps'] for result in results)
+    failed = [result['name'] for result in results if result['error'] != None]
+    report(f'Extracted {len(results)-len(failed)}/{len(results)} items ({spritemap_count} spritemaps) in {elapsed:.2f} s, '
+           f'{len(results)/elapsed:.1f} items/s, {spritemap_count/elapsed:.1f} spritemaps/s')
+    if failed:
+        report(f'Failed: {", ".join(str(name) for name in failed)}')
+
+def extract_batch(rom_path, jobs, folder_name, exports=(), report=print):
+    '''Loads the ROM once, then extracts every job to a project JSON in folder_name
+
+    Returns the summaries of the jobs, in the order of jobs.
+    '''
+    start = time.perf_counter()
+    with RomHandlerParent(rom_path, use_mmap=True) as rom:
+        report(f'Loaded {rom_path} in {(time.perf_counter()-start)*1000:.1f} ms')
+
+        results = []
+        for job in jobs:
+            results.append(process_job(rom, job, folder_name, exports))
+            report_result(results[-1], report)
+
+    report_summary(results, time.perf_counter() - start, report)
+    return results
+
+# the ROM of a worker process, memory mapped so that every worker shares the same pages instead of getting a pickled copy
+_worker_rom = None
+
+def _init_worker(rom_path):
+    global _worker_rom
+    _worker_rom = RomHandlerParent(rom_path, use_mmap=True)
+    # worker processes don't run atexit handlers, but they do run multiprocessing finalizers
+    Finalize(_worker_rom, _worker_rom.close, exitpriority=0)
+
+def _process_job_in_worker(job, folder_name, exports):
+    return process_job(_worker_rom, job, folder_name, exports)
+
+def extract_batch_parallel(rom_path, jobs, folder_name, exports=(), workers=None, report=print):
+    '''extract_batch() over a pool of worker processes (as many as CPU cores if workers is None)
+
+    Results are reported as soon as each job finishes, and returned in the order of jobs.
+    '''
+    start = time.perf_counter()
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rom_path,)) as executor:
+        futures = {executor.submit(_process_job_in_worker, job, folder_name, exports): i for i, job in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception: # the worker itself died (e.g. BrokenProcessPool)
+                results[i] = {'name': jobs[i].get('name'), 'spritemaps': 0, 'ext_hitboxes': 0, 'ext_spritemaps': 0,
+                              'error': traceback.format_exc(), 'time': 0}
+            report_result(results[i], report, f'[{done}/{len(jobs)}] ')
+
+    report_summary(results, time.perf_counter() - start, report)
+    return results
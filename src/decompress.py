@@ -1,7 +1,14 @@
 from src.romhandler import RomHandlerParent
+from collections import deque
+import numpy as np
+
+# lookup tables for bytes.translate() and slicing
+_INVERT = bytes(b ^ 0xFF for b in range(0x100))
+_INCREMENT = bytes(range(0x100)) * 5 # long enough for any size starting from any byte
 
 ''' Based on https://patrickjohnston.org/ASM/ROM%20data/Super%20Metroid/decompress.py '''
-def decompress(rom, start):
+def decompress_reference(rom, start):
+    # the straightforward version of decompress(), kept as a reference to check it against
     curr_addr = rom.convert_to_pc_address(start) # for bankcross
     decompressed = bytearray()
     while True:
@@ -57,3 +64,312 @@ def decompress(rom, start):
                 decompressed.append(decompressed[i] ^ 0xFF)
 
     return decompressed
+
+def decompress(rom, start):
+    with rom.get_view() as data:
+        return decompress_data(data, rom.convert_to_pc_address(start)) # for bankcross
+
+def decompress_data(data, addr):
+    '''Decompresses from a buffer (bytes, memoryview...) starting at addr, the same as decompress_reference()'''
+    decompressed = bytearray()
+    while True:
+        byte = data[addr]
+        addr += 1
+        if byte == 0xFF:
+            break
+
+        command = byte >> 5
+        if command != 7:
+            size = (byte & 0x1F) + 1
+        else:
+            size = ((byte & 3) << 8 | data[addr]) + 1
+            addr += 1
+            command = byte >> 2 & 7
+
+        if command == 0:
+            decompressed += data[addr:addr+size]
+            addr += size
+        elif command == 1:
+            decompressed += bytes((data[addr],)) * size
+            addr += 1
+        elif command == 2:
+            word = bytes((data[addr], data[addr+1]))
+            addr += 2
+            decompressed += word * (size >> 1)
+            if size & 1:
+                decompressed.append(word[0])
+        elif command == 3:
+            byte = data[addr]
+            addr += 1
+            decompressed += _INCREMENT[byte:byte+size]
+        else:
+            if command < 6:
+                offset = data[addr] | data[addr+1] << 8
+                addr += 2
+            else:
+                offset = len(decompressed) - data[addr]
+                addr += 1
+
+            if offset >= 0 and offset + size <= len(decompressed):
+                # the source doesn't overlap what's being written, copy it all at once
+                if command & 1:
+                    decompressed += decompressed[offset:offset+size].translate(_INVERT)
+                else:
+                    decompressed += decompressed[offset:offset+size]
+            elif 0 <= offset < len(decompressed) and not command & 1:
+                # the source runs into the bytes being written, so it repeats with a period of the distance
+                pattern = decompressed[offset:]
+                decompressed += (pattern * (size // len(pattern) + 1))[:size]
+            else:
+                # inverted overlapping copies alternate with every period, and out of range offsets behave like the reference
+                mask = 0xFF if command & 1 else 0
+                for i in range(offset, offset + size):
+                    decompressed.append(decompressed[i] ^ mask)
+
+    return decompressed
+
+_MAX_SIZE = 0x400
+_MAX_INVERTED_RELATIVE_SIZE = 0x300 # its extended header would be $FF (the end marker) past that
+_MAX_CHAIN = 32 # how many previous occurrences get checked for dictionary copies
+
+def _command_cost(command, size):
+    header = 1 if size <= 32 and command != 7 else 2
+    return header + (size if command == 0 else (1, 2, 1, 2, 2, 1, 1)[command-1])
+
+# _SAVINGS[command][size]: how many bytes a command of that size saves over a direct copy of the same bytes
+_SAVINGS = [[size - _command_cost(command, size) for size in range(_MAX_SIZE + 1)] for command in range(8)]
+
+def _emit(compressed, command, size, args):
+    # the header, then the arguments
+    if size <= 32 and command != 7:
+        compressed.append(command << 5 | (size - 1))
+    else:
+        compressed.append(0xE0 | command << 2 | (size - 1) >> 8)
+        compressed.append((size - 1) & 0xFF)
+    compressed += args
+
+def _common_length(a, a_start, b, b_start, limit, good=0):
+    '''Returns the length of the common prefix of a[a_start:] and b[b_start:], up to limit, knowing the first good bytes match'''
+    # gallop then binary search, so every comparison is a slice comparison
+    step = 1
+    while good + step <= limit and a[a_start:a_start+good+step] == b[b_start:b_start+good+step]:
+        good += step
+        step *= 2
+    while step > 1:
+        step //= 2
+        if good + step <= limit and a[a_start:a_start+good+step] == b[b_start:b_start+good+step]:
+            good += step
+    return good
+
+def _run_lengths(continues):
+    '''Returns how many positions in a row continues is True for, starting at each position'''
+    positions = np.arange(len(continues))
+    # the first position from each one on where it stops, found with a running minimum from the end
+    stops = np.minimum.accumulate(np.where(continues, len(continues), positions)[::-1])[::-1]
+    return stops - positions
+
+def compress(data):
+    '''Compresses data into the format read by decompress(), returns a bytearray ending with $FF'''
+    data = bytes(data)
+    inverted = data.translate(_INVERT)
+    length = len(data)
+
+    # lengths of the byte fill, word fill and incrementing fill starting at every position
+    values = np.frombuffer(data, dtype=np.uint8).astype(np.int32)
+    byte_fill = np.append(_run_lengths(values[1:] == values[:-1]) + 1, [1, 1])
+    increment_fill = np.append(_run_lengths(values[1:] == (values[:-1] + 1) & 0xFF) + 1, [1, 1])
+    # how many bytes from here on equal the byte 2 before them
+    word_repeat = np.concatenate(([0, 0][:length], _run_lengths(values[2:] == values[:-2]), [0, 0]))
+
+    # the 3 byte prefix at every position as a number, the inverted prefix is that ^ 0xFFFFFF
+    keys = values[:-2] << 16 | values[1:-1] << 8 | values[2:]
+
+    # positions where no command can be found: no fill, and neither their prefix nor its inverse occurred before.
+    # they get skipped in bulk, which is most of the work on data that doesn't compress well
+    (unique_keys, first_occurrences) = np.unique(keys, return_index=True)
+    def occurred_before(prefixes):
+        found = np.minimum(np.searchsorted(unique_keys, prefixes), max(0, len(unique_keys) - 1))
+        return (unique_keys[found] == prefixes) & (first_occurrences[found] < np.arange(len(prefixes))) if len(keys) > 0 else np.zeros(0, dtype=bool)
+    worth_a_look = (byte_fill[:length] > 2) | (word_repeat[2:length+2] > 1) | (increment_fill[:length] > 2)
+    worth_a_look[:len(keys)] |= occurred_before(keys) | occurred_before(keys ^ 0xFFFFFF)
+    nothing_to_find = _run_lengths(~worth_a_look).tolist()
+
+    (byte_fill, increment_fill, word_repeat, keys) = (byte_fill.tolist(), increment_fill.tolist(), word_repeat.tolist(), keys.tolist())
+
+    chains = {} # 3 byte prefix -> the last _MAX_CHAIN positions it occurs at
+    compressed = bytearray()
+    literal_start = 0
+    i = 0
+    while i < length:
+        if nothing_to_find[i] > 0:
+            # extend the direct copy over all of them
+            end = i + nothing_to_find[i]
+            for k in range(i, min(end, length - 2)):
+                key = keys[k]
+                if key in chains:
+                    chains[key].append(k)
+                else:
+                    chains[key] = deque((k,), _MAX_CHAIN)
+            i = end
+            continue
+
+        limit = min(_MAX_SIZE, length - i)
+
+        # the best command found so far as savings over a direct copy, command, size and the position it copies from
+        best = (0, 0, 0, 0)
+
+        # fills are only worth it from 3 bytes (4 for words)
+        if byte_fill[i] > 2:
+            size = min(byte_fill[i], limit)
+            best = max(best, (_SAVINGS[1][size], 1, size, 0))
+        if word_repeat[i+2] > 1:
+            size = min(2 + word_repeat[i+2], limit)
+            best = max(best, (_SAVINGS[2][size], 2, size, 0))
+        if increment_fill[i] > 2:
+            size = min(increment_fill[i], limit)
+            best = max(best, (_SAVINGS[3][size], 3, size, 0))
+
+        # dictionary copies, plain matches come from data and inverted ones from its complement
+        for (command, source, key_mask) in ((4, data, 0), (5, inverted, 0xFFFFFF)):
+            # savings only grow with the size and inverted copies never save more than plain ones,
+            # so nothing left can beat a command that saves more than a copy of all of limit
+            most = max(_SAVINGS[command][limit], _SAVINGS[command + 2][limit])
+            if best[0] > most or i >= length - 2:
+                break
+            chain = chains.get(keys[i] ^ key_mask)
+            if chain is None:
+                continue
+            for j in reversed(chain):
+                if best[0] > most:
+                    break
+                # skip candidates that can't even match as far as the best one so far
+                last = best[2] - 1
+                if last > 2 and source[j+last] != data[i+last]:
+                    continue
+                # the chain already matches 3 bytes, and most candidates don't match a 4th
+                if limit == 3 or source[j+3] != data[i+3]:
+                    size = 3
+                else:
+                    size = _common_length(source, j, data, i, limit, 4)
+                if i - j <= 0xFF:
+                    relative_size = min(size, _MAX_INVERTED_RELATIVE_SIZE) if command == 5 else size
+                    candidate = (_SAVINGS[command + 2][relative_size], command + 2, relative_size, j)
+                    if candidate > best:
+                        best = candidate
+                if j <= 0xFFFF:
+                    candidate = (_SAVINGS[command][size], command, size, j)
+                    if candidate > best:
+                        best = candidate
+                if size == limit:
+                    break
+
+        # breaking up a direct copy costs a header, so only do it if it's worth it
+        (savings, command, size, j) = best
+        if savings > (1 if literal_start < i else 0):
+            for start in range(literal_start, i, _MAX_SIZE):
+                end = min(start + _MAX_SIZE, i)
+                _emit(compressed, 0, end - start, data[start:end])
+            if command == 2:
+                args = data[i:i+2]
+            elif command < 4:
+                args = data[i:i+1]
+            elif command < 6:
+                args = j.to_bytes(2, 'little')
+            else:
+                args = bytes((i - j,))
+            _emit(compressed, command, size, args)
+            end = i + size
+            literal_start = end
+        else:
+            end = i + 1
+
+        for k in range(i, min(end, length - 2)):
+            key = keys[k]
+            if key in chains:
+                chains[key].append(k)
+            else:
+                chains[key] = deque((k,), _MAX_CHAIN)
+        i = end
+
+    for start in range(literal_start, length, _MAX_SIZE):
+        end = min(start + _MAX_SIZE, length)
+        _emit(compressed, 0, end - start, data[start:end])
+
+    compressed.append(0xFF)
+    return compressed
+
+# sizes right around the limits of the format: the short header, the extended header and inverted relative copies
+_EDGE_SIZES = (1, 2, 3, 4, 31, 32, 33, _MAX_INVERTED_RELATIVE_SIZE - 1, _MAX_INVERTED_RELATIVE_SIZE, _MAX_INVERTED_RELATIVE_SIZE + 1, _MAX_SIZE - 1, _MAX_SIZE, _MAX_SIZE + 1)
+
+def _random_round_trip_input(rng):
+    '''Returns data made of pieces that each command can compress: literals, runs, repeats, and plain, inverted and relative matches'''
+    data = bytearray()
+    target = rng.choice(_EDGE_SIZES + (rng.randrange(1, 0x2000),))
+    while len(data) < target:
+        size = rng.choice(_EDGE_SIZES) if rng.random() < 0.5 else rng.randrange(1, 0x80)
+        kind = rng.randrange(8) if len(data) > 0 else 0
+        if kind == 0: # literal
+            data += bytes(rng.randrange(0x100) for i in range(size))
+        elif kind == 1: # byte run
+            data += bytes((rng.randrange(0x100),)) * size
+        elif kind == 2: # word repeat
+            data += (bytes((rng.randrange(0x100), rng.randrange(0x100))) * size)[:size]
+        elif kind == 3: # incrementing run
+            data += _INCREMENT[rng.randrange(0x100):][:size]
+        else:
+            # matches of earlier data, anywhere or within the last $FF bytes, plain or inverted (also overlapping)
+            start = rng.randrange(len(data)) if kind < 6 else max(0, len(data) - rng.randrange(1, 0x100))
+            source = bytearray(data)
+            for i in range(size):
+                source.append(source[start + i])
+            match = source[len(data):]
+            data += match.translate(_INVERT) if kind & 1 else match
+    return bytes(data[:target])
+
+def check_round_trip(count=500, seed=0):
+    '''Checks decompress_data(compress(data)) == data on count random inputs'''
+    import random
+    rng = random.Random(seed)
+    for i in range(count):
+        data = _random_round_trip_input(rng)
+        compressed = compress(data)
+        if decompress_data(compressed, 0) != data:
+            raise AssertionError(f'round trip failed on input {i} of seed {seed}: {data.hex()}')
+
+def benchmark(target=0.5):
+    '''Times compress() on 64 KiB of synthetic sprite tiles, random bytes and zeros, the tiles should take less than target seconds'''
+    import random, time
+    from src.gfx import convert_tiles_to_bitplanes
+
+    # synthetic sprite tiles: blobs of a few colors on transparency, some of them repeated or flipped
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:8, 0:8]
+    tiles = []
+    for i in range(0x800):
+        if tiles and rng.random() < 0.25:
+            tile = tiles[rng.integers(len(tiles))][:, ::-1]
+        else:
+            (cy, cx, r) = rng.integers(0, 8, 3)
+            blob = (y-cy)**2 + (x-cx)**2 <= r*r
+            tile = np.where(blob, rng.integers(1, 4) + (rng.random((8, 8)) < 0.2), 0).astype(np.uint8)
+        tiles.append(tile)
+    data = convert_tiles_to_bitplanes(np.array(tiles))
+
+    random.seed(0)
+    for (name, sample) in (('tiles', data), ('random', bytes(random.randrange(0x100) for i in range(0x10000))), ('zeros', bytes(0x10000))):
+        start = time.perf_counter()
+        compressed = compress(sample)
+        elapsed = time.perf_counter() - start
+        if decompress_data(compressed, 0) != sample:
+            raise AssertionError('round trip failed')
+        print(f'{name}: {len(sample):#x} bytes -> {len(compressed):#x} bytes, ratio {len(compressed)/len(sample):.3f}, {elapsed:.3f} s ({len(sample)/elapsed/1024:.0f} KiB/s)')
+        if name == 'tiles':
+            print(f'tiles {"within" if elapsed < target else "OVER"} the {target} s target')
+
+def main():
+    check_round_trip()
+    print('round trip ok')
+    benchmark()
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 from src.romhandler import RomHandlerParent
-from src.gfx import add_to_canvas_from_spritemap, bounding_box, to_qimage
+from src.gfx import TileCache, new_canvas, canvas_reach, add_to_canvas_from_spritemap, bounding_box, crop_canvas, clear_out_of_palette, indexed_image_from_buffer, to_qimage
 from src.decompress import decompress
-import base64, os, struct
+import numpy as np
+import base64, json, os, struct
 
 def decode_spritemap_entry(entry):
     return {
@@ -24,7 +25,50 @@ def encode_spritemap_entry(entry):
         ((entry['tile'] & 0x100) >> 8) | ((entry['palette'] & 0b111) << 1) | ((entry['bg_priority'] & 0b11) << 4) | (0x40 * entry['h_flip']) | (0x80 * entry['v_flip'])
     )
 
-def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pal_offset, spritemap_range, ext_hitbox_range, ext_spritemap_range, name, compressed_gfx=False):
+def decode_spritemap_entries(raw):
+    '''decode_spritemap_entry() for a whole table of 5 byte entries at once'''
+    entries = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 5).astype(np.int32)
+
+    fields = (
+        entries[:, 0] - ((entries[:, 1] & 0x01) << 8),  # x
+        (entries[:, 2] & 0x7F) - (entries[:, 2] & 0x80),  # y
+        entries[:, 1] & 0x80 == 0x80,                     # big
+        entries[:, 3] + ((entries[:, 4] & 0x01) << 8),  # tile
+        entries[:, 4] >> 1 & 0b111,                       # palette
+        entries[:, 4] >> 4 & 0b11,                        # bg_priority
+        entries[:, 4] & 0x40 == 0x40,                     # h_flip
+        entries[:, 4] & 0x80 == 0x80                      # v_flip
+    )
+    return [{
+        'x': x,
+        'y': y,
+        'big': big,
+        'tile': tile,
+        'palette': palette,
+        'bg_priority': bg_priority,
+        'h_flip': h_flip,
+        'v_flip': v_flip
+    } for x, y, big, tile, palette, bg_priority, h_flip, v_flip in zip(*(field.tolist() for field in fields))]
+
+def read_spritemap_table(rom, addr, count):
+    '''Reads and decodes count spritemap entries in one go'''
+    return decode_spritemap_entries(rom.bulk_read_from_snes_address(addr, count*5))
+
+def read_hitbox_table(rom, addr, count):
+    '''Reads count hitbox entries in one go, as (left, top, right, bottom, touch, shot) tuples of unsigned words'''
+    return list(struct.iter_unpack('<6H', rom.bulk_read_from_snes_address(addr, count*12)))
+
+def read_ext_spritemap_table(rom, addr, count):
+    '''Reads count extended spritemap entries in one go, as (x, y, spritemap, hitbox) tuples of unsigned words'''
+    return list(struct.iter_unpack('<4H', rom.bulk_read_from_snes_address(addr, count*8)))
+
+def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pal_offset, spritemap_range, ext_hitbox_range, ext_spritemap_range, name, compressed_gfx=False, progress=None):
+    # progress, if given, gets called with the number of spritemaps, hitboxes and extended spritemaps parsed so far after each one
+    # it can raise an exception to cancel the extraction
+    def report_progress():
+        if progress != None:
+            progress(len(spritemaps), len(ext_hitboxes), len(ext_spritemaps))
+
     if compressed_gfx:
         gfx = decompress(rom, gfx_addr) # ignore size when gfx is compressed
     else:
@@ -39,6 +83,10 @@ def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pa
     ], 'big') for color555 in palette555]
 
     spritemaps = []
+    ext_hitboxes = []
+    ext_spritemaps = []
+
+    spritemaps_by_addr = {} # to resolve the references in extended spritemaps
     curr_addr = spritemap_range[0]
     spritemap_i = 0
     while True:
@@ -52,18 +100,18 @@ def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pa
         if curr_addr+2+count*5 > (spritemap_range[0] & 0xFF0000) + 0x10000: # abort if bankcross
             break
 
-        spritemap = []
-        for i in range(count):
-            spritemap.append(decode_spritemap_entry(rom.bulk_read_from_snes_address(curr_addr+2+i*5, 5)))
+        spritemap = read_spritemap_table(rom, curr_addr+2, count)
 
         spritemaps.append({
             'name': f'{name}Spritemap_{spritemap_i:X}_{curr_addr:06X}',
             'spritemap': spritemap
         })
+        spritemaps_by_addr[curr_addr] = spritemaps[-1]
         curr_addr += 2+count*5
         spritemap_i += 1
+        report_progress()
 
-    ext_hitboxes = []
+    hitboxes_by_addr = {}
     if ext_hitbox_range[0] != None:
         curr_addr = ext_hitbox_range[0]
         hitbox_i = 0
@@ -77,8 +125,7 @@ def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pa
 
             hitbox = []
             valid = True
-            for i in range(count):
-                left, top, right, bottom, touch, shot = rom.read_from_snes_address(curr_addr+2+i*12, '2'*6)
+            for left, top, right, bottom, touch, shot in read_hitbox_table(rom, curr_addr+2, count):
                 if touch < 0x8000 or shot < 0x8000:
                     valid = False
                     break
@@ -98,10 +145,11 @@ def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pa
                 'spritemap': None,
                 'hitbox': hitbox
             })
+            hitboxes_by_addr[curr_addr] = ext_hitboxes[-1]
             curr_addr += 2+count*12
             hitbox_i += 1
+            report_progress()
 
-    ext_spritemaps = []
     if ext_spritemap_range[0] != None:
         curr_addr = ext_spritemap_range[0]
         ext_spritemap_i = 0
@@ -118,30 +166,25 @@ def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pa
 
             ext_spritemap = []
             valid = True
-            for i in range(count):
-                x, y, spritemap, hitbox = rom.read_from_snes_address(curr_addr+2+i*8, '2'*4)
+            for x, y, spritemap, hitbox in read_ext_spritemap_table(rom, curr_addr+2, count):
                 if spritemap < 0x8000 or hitbox < 0x8000:
                     valid = False
                     break
 
-                spritemap_found = False
-                for s in spritemaps:
-                    if f'{(spritemap_range[0]&0xFF0000)+spritemap:06X}' in s['name']:
-                        spritemap = s['name']
-                        spritemap_found = True
-                        break
-                if not spritemap_found:
+                # the pointers are relative to the bank of their table
+                s = spritemaps_by_addr.get((spritemap_range[0]&0xFF0000)+spritemap)
+                spritemap_found = s != None
+                if spritemap_found:
+                    spritemap = s['name']
+                else:
                     spritemap = f'${spritemap:04X}'
 
-                hitbox_found = False
-                for h in ext_hitboxes:
-                    if f'{(ext_hitbox_range[0]&0xFF0000)+hitbox:06X}' in h['name']:
-                        hitbox = h['name']
-                        if spritemap_found:
-                            h['spritemap'] = spritemap
-                        hitbox_found = True
-                        break
-                if not hitbox_found:
+                h = hitboxes_by_addr.get((ext_hitbox_range[0]&0xFF0000)+hitbox) if ext_hitbox_range[0] != None else None
+                if h != None:
+                    hitbox = h['name']
+                    if spritemap_found:
+                        h['spritemap'] = spritemap
+                else:
                     hitbox = f'${hitbox:04X}'
 
                 ext_spritemap.append({
@@ -159,6 +202,7 @@ def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pa
             })
             curr_addr += 2+count*8
             ext_spritemap_i += 1
+            report_progress()
 
     return {
         'game': 'sm',
@@ -172,55 +216,77 @@ def extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pa
         'ext_spritemaps': ext_spritemaps
     }
 
-def extract_enemy(rom, id, spritemap_range, ext_hitbox_range, ext_spritemap_range, name):
+def extract_enemy(rom, id, spritemap_range, ext_hitbox_range, ext_spritemap_range, name, progress=None):
     gfx_size = (rom.read_from_snes_address(0xA00000+id, 2) & 0x7FFF) // 32
     bank = rom.read_from_snes_address(0xA00000+id+0xC, 1)
     pal_addr = (bank<<16)+rom.read_from_snes_address(0xA00000+id+2, 2)
     gfx_addr = rom.read_from_snes_address(0xA00000+id+0x36, 3)
 
-    return extract_generic(rom, gfx_addr, gfx_size, 256, pal_addr, 1, 0, spritemap_range, ext_hitbox_range, ext_spritemap_range, name)
-
-def export_to_asm(data, folder_name):
-    file = open(os.path.join(folder_name, data['name']+'.asm') , 'w')
-
-    file.write(f'{data['name']}Gfx:\nincbin \"{data['name']+'.gfx'}\"\n\n')
-    file.write(f'{data['name']}Pal:\nincbin \"{data['name']+'.pal'}\"\n')
+    return extract_generic(rom, gfx_addr, gfx_size, 256, pal_addr, 1, 0, spritemap_range, ext_hitbox_range, ext_spritemap_range, name, progress=progress)
 
-    for spritemap in data['spritemaps']:
-        file.write(f'\n{spritemap['name']}:\n')
-        file.write(f'dw ${len(spritemap['spritemap']):04X}')
-        if len(spritemap['spritemap']) > 0:
-            file.write(' : db ' + ', '.join(','.join(f'${b:02X}' for b in encode_spritemap_entry(entry)) for entry in spritemap['spritemap']))
-        file.write('\n')
-
-    for hitbox in data['ext_hitboxes']:
-        file.write(f'\n{hitbox['name']}:\n')
-        file.write(f'dw ${len(hitbox['hitbox']):04X}')
-        if len(hitbox['hitbox']) > 0:
-            file.write(', ' + ', '.join(f'{entry['left']},{entry['top']},{entry['right']},{entry['bottom']},{entry['touch']},{entry['shot']}' for entry in hitbox['hitbox']))
-        file.write('\n')
-
-    for ext_spritemap in data['ext_spritemaps']:
-        file.write(f'\n{ext_spritemap['name']}:\n')
-        file.write(f'dw ${len(ext_spritemap['ext_spritemap']):04X}')
-        if len(ext_spritemap['ext_spritemap']) > 0:
-            file.write(', ' + ', '.join(f'{entry['x']},{entry['y']},{entry['spritemap']},{entry['hitbox']}' for entry in ext_spritemap['ext_spritemap']))
-        file.write('\n')
-    
-    file = open(os.path.join(folder_name, data['name']+'.gfx') , 'wb')
-    file.write(base64.b64decode(bytes(data['gfx'], 'utf8')))
-
-    file = open(os.path.join(folder_name, data['name']+'.pal') , 'wb')
+def encode_palette(palette):
+    '''Converts ARGB32 colors to SNES BGR555'''
     palette555 = bytearray()
-    for color in data['palette']:
+    for color in palette:
         r = (color >> 16 & 0xFF) >> 3
         g = (color >> 8 & 0xFF) >> 3 << 5
         b = (color & 0xFF) >> 3 << 10
         palette555.extend(struct.pack('<H', r | g | b))
-    file.write(palette555)
-
-def export_to_png(data, folder_name):
-    gfx = bytearray(base64.b64decode(bytes(data['gfx'], 'utf8')))
+    return palette555
+
+def asm_db_block(label, raw, bytes_per_line=16):
+    lines = [f'{label}:\n']
+    for i in range(0, len(raw), bytes_per_line):
+        lines.append('db ' + ','.join(f'${b:02X}' for b in raw[i:i+bytes_per_line]) + '\n')
+    return ''.join(lines)
+
+def asm_spritemap(spritemap):
+    line = f'dw ${len(spritemap['spritemap']):04X}'
+    if len(spritemap['spritemap']) > 0:
+        line += ' : db ' + ', '.join(','.join(f'${b:02X}' for b in encode_spritemap_entry(entry)) for entry in spritemap['spritemap'])
+    return f'\n{spritemap['name']}:\n{line}\n'
+
+def asm_hitbox(hitbox):
+    line = f'dw ${len(hitbox['hitbox']):04X}'
+    if len(hitbox['hitbox']) > 0:
+        line += ', ' + ', '.join(f'{entry['left']},{entry['top']},{entry['right']},{entry['bottom']},{entry['touch']},{entry['shot']}' for entry in hitbox['hitbox'])
+    return f'\n{hitbox['name']}:\n{line}\n'
+
+def asm_ext_spritemap(ext_spritemap):
+    line = f'dw ${len(ext_spritemap['ext_spritemap']):04X}'
+    if len(ext_spritemap['ext_spritemap']) > 0:
+        line += ', ' + ', '.join(f'{entry['x']},{entry['y']},{entry['spritemap']},{entry['hitbox']}' for entry in ext_spritemap['ext_spritemap'])
+    return f'\n{ext_spritemap['name']}:\n{line}\n'
+
+def write_asm(data, stream, combined=False):
+    '''Writes the ASM of a project to a text stream, one write per section
+
+    If combined, the GFX and palette are in it as db blocks instead of incbins of the files export_to_asm() writes.
+    '''
+    if combined:
+        stream.write(asm_db_block(data['name']+'Gfx', base64.b64decode(bytes(data['gfx'], 'utf8'))) + '\n')
+        stream.write(asm_db_block(data['name']+'Pal', encode_palette(data['palette'])))
+    else:
+        stream.write(f'{data['name']}Gfx:\nincbin \"{data['name']+'.gfx'}\"\n\n')
+        stream.write(f'{data['name']}Pal:\nincbin \"{data['name']+'.pal'}\"\n')
+
+    stream.write(''.join(asm_spritemap(spritemap) for spritemap in data['spritemaps']))
+    stream.write(''.join(asm_hitbox(hitbox) for hitbox in data['ext_hitboxes']))
+    stream.write(''.join(asm_ext_spritemap(ext_spritemap) for ext_spritemap in data['ext_spritemaps']))
+
+def export_to_asm(data, folder_name, combined=False):
+    '''Writes <name>.asm, and unless combined, the <name>.gfx and <name>.pal files it includes'''
+    with open(os.path.join(folder_name, data['name']+'.asm'), 'w') as file:
+        write_asm(data, file, combined)
+
+    if not combined:
+        with open(os.path.join(folder_name, data['name']+'.gfx'), 'wb') as file:
+            file.write(base64.b64decode(bytes(data['gfx'], 'utf8')))
+        with open(os.path.join(folder_name, data['name']+'.pal'), 'wb') as file:
+            file.write(encode_palette(data['palette']))
+
+def export_palettes(data):
+    '''Returns the color table the exported images use, with every palette row'''
     palettes = []
     for i in range(data['palette_offset']):
         palettes.extend([0]+[0xFF000000]*16)
@@ -228,35 +294,146 @@ def export_to_png(data, folder_name):
         palettes.extend([0]+data['palette'][i+1:i+16])
     for i in range(8-len(palettes)):
         palettes.extend([0]+[0xFF000000]*16)
-
+    return palettes
+
+def add_spritemap_to_canvas(canvas, data, tiles, spritemap, x=0, y=0):
+    '''Draws a spritemap of the project on a canvas, its first entry on top'''
+    for entry in reversed(spritemap['spritemap']):
+        copied = entry.copy()
+        copied['x'] += x
+        copied['y'] += y
+        copied['tile'] = entry['tile']-data['gfx_offset']
+        copied['palette'] = entry['palette']-data['palette_offset']
+        add_to_canvas_from_spritemap(canvas, [copied], tiles)
+
+def render_spritemap(data, tiles, spritemap):
+    canvas = new_canvas(*canvas_reach(spritemap['spritemap']))
+    add_spritemap_to_canvas(canvas, data, tiles, spritemap)
+    return canvas
+
+def render_ext_spritemap(data, tiles, ext_spritemap, spritemaps_by_name):
+    '''spritemaps_by_name: see spritemaps_by_name(), references to missing spritemaps are skipped'''
+    parts = []
+    for ext_spritemap_entry in reversed(ext_spritemap['ext_spritemap']):
+        spritemap = spritemaps_by_name.get(ext_spritemap_entry['spritemap'])
+        if spritemap != None:
+            parts.append((spritemap, ext_spritemap_entry['x'], ext_spritemap_entry['y']))
+
+    # the parts are moved by their offsets, so the canvas has to be big enough for wherever they end up
+    (half_width, half_height) = (0, 0)
+    for spritemap, x, y in parts:
+        (part_width, part_height) = canvas_reach(spritemap['spritemap'], x, y)
+        (half_width, half_height) = (max(half_width, part_width), max(half_height, part_height))
+
+    canvas = new_canvas(half_width, half_height)
+    for spritemap, x, y in parts:
+        add_spritemap_to_canvas(canvas, data, tiles, spritemap, x, y)
+    return canvas
+
+def spritemaps_by_name(data):
+    '''The first spritemap with each name'''
+    by_name = {}
     for spritemap in data['spritemaps']:
-        canvas = {}
-        for entry in reversed(spritemap['spritemap']):
-            copied = entry.copy()
-            copied['tile'] = entry['tile']-data['gfx_offset']
-            copied['palette'] = entry['palette']-data['palette_offset']
-            add_to_canvas_from_spritemap(canvas, [copied], gfx)
+        by_name.setdefault(spritemap['name'], spritemap)
+    return by_name
 
-        (width, height) = bounding_box(canvas)
-        image = to_qimage(canvas, palettes, -width, -height, width, height)
-        image.save(os.path.join(folder_name, spritemap['name']+'.png'))
+def render_frames(data):
+    '''Yields (kind, name, canvas) for every spritemap ('spritemap') and then every extended spritemap ('ext_spritemap')'''
+    tiles = TileCache(base64.b64decode(bytes(data['gfx'], 'utf8')))
+    for spritemap in data['spritemaps']:
+        yield ('spritemap', spritemap['name'], render_spritemap(data, tiles, spritemap))
 
+    by_name = spritemaps_by_name(data)
     for ext_spritemap in data['ext_spritemaps']:
-        canvas = {}
-        for ext_spritemap_entry in reversed(ext_spritemap['ext_spritemap']):
-            spritemap_name = ext_spritemap_entry['spritemap']
-            for spritemap in data['spritemaps']:
-                if spritemap['name'] == spritemap_name:
-                    break
-
-            for entry in reversed(spritemap['spritemap']):
-                copied = entry.copy()
-                copied['x'] += ext_spritemap_entry['x']
-                copied['y'] += ext_spritemap_entry['y']
-                copied['tile'] = entry['tile']-data['gfx_offset']
-                copied['palette'] = entry['palette']-data['palette_offset']
-                add_to_canvas_from_spritemap(canvas, [copied], gfx)
+        yield ('ext_spritemap', ext_spritemap['name'], render_ext_spritemap(data, tiles, ext_spritemap, by_name))
+
+def shelf_pack(sizes, max_width, max_height=None):
+    '''Places (width, height) rectangles in rows, tallest first, starting a new page when a row doesn't fit in max_height
+
+    Returns the (page, x, y) of each rectangle in the order of sizes, and the (width, height) each page takes.
+    '''
+    positions = [None]*len(sizes)
+    pages = [(0, 0)]
+    (x, y, shelf_height) = (0, 0, 0)
+    for i in sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0])):
+        (w, h) = sizes[i]
+        if x > 0 and x+w > max_width: # start a new shelf
+            (x, y, shelf_height) = (0, y+shelf_height, 0)
+        if max_height != None and x == 0 and y > 0 and y+h > max_height: # start a new page
+            pages.append((0, 0))
+            (x, y, shelf_height) = (0, 0, 0)
+        positions[i] = (len(pages)-1, x, y)
+        x += w
+        shelf_height = max(shelf_height, h)
+        pages[-1] = (max(pages[-1][0], x), max(pages[-1][1], y+shelf_height))
+    return (positions, pages)
+
+def build_atlas_pages(canvases, max_width=1024, max_height=None):
+    '''Crops each canvas to its bounding box and packs them in buffers of color indices, as few as fit in max_height
+
+    Returns the buffers and (page, x, y, width, height, origin x, origin y) of each frame.
+    '''
+    crops = []
+    for canvas in canvases:
+        (width, height) = bounding_box(canvas)
+        crops.append(crop_canvas(canvas, -width, -height, width, height))
+
+    (positions, page_sizes) = shelf_pack([(crop.shape[1], crop.shape[0]) for crop in crops], max_width, max_height)
+    pages = [np.zeros((page_height, page_width), dtype=np.int16) for page_width, page_height in page_sizes]
+    frames = []
+    for crop, (page, x, y) in zip(crops, positions):
+        (height, width) = crop.shape
+        pages[page][y:y+height, x:x+width] = crop
+        frames.append((page, x, y, width, height, width//2, height//2))
+    return (pages, frames)
+
+def build_atlas(canvases, max_width=1024):
+    '''build_atlas_pages() on a single page, returns the buffer and (x, y, width, height, origin x, origin y) of each frame'''
+    (pages, frames) = build_atlas_pages(canvases, max_width)
+    return (pages[0], [frame[1:] for frame in frames])
 
+def export_to_png(data, folder_name):
+    palettes = export_palettes(data)
+    for kind, name, canvas in render_frames(data):
         (width, height) = bounding_box(canvas)
         image = to_qimage(canvas, palettes, -width, -height, width, height)
-        image.save(os.path.join(folder_name, ext_spritemap['name']+'.png'))
+        image.save(os.path.join(folder_name, name+'.png'))
+
+def export_to_png_atlas(data, folder_name, max_width=1024, max_height=1024):
+    '''Exports every frame packed in as few indexed PNGs as fit in max_width x max_height, and a JSON file
+    with each frame's page, rectangle and origin (the position of the spritemap's (0, 0) in the rectangle)'''
+    frame_names = []
+    canvases = []
+    for kind, name, canvas in render_frames(data):
+        frame_names.append((kind, name))
+        canvases.append(canvas)
+    (pages, frames) = build_atlas_pages(canvases, max_width, max_height)
+
+    palettes = export_palettes(data)
+    page_names = []
+    page_numbers = {} # index in pages -> index in page_names, pages with nothing but empty frames aren't written
+    for i, page in enumerate(pages):
+        if page.size == 0:
+            continue
+        page_numbers[i] = len(page_names)
+        page_names.append(f'{data["name"]}_atlas_{len(page_names)}.png')
+        clear_out_of_palette(page, palettes)
+        indexed_image_from_buffer(page, palettes).save(os.path.join(folder_name, page_names[-1]))
+
+    sidecar = {
+        'name': data['name'],
+        'pages': page_names,
+        'frames': [{
+            'kind': kind,
+            'name': name,
+            'page': page_numbers.get(page), # None for empty frames on a page that wasn't written
+            'x': x,
+            'y': y,
+            'width': width,
+            'height': height,
+            'origin_x': origin_x,
+            'origin_y': origin_y
+        } for (kind, name), (page, x, y, width, height, origin_x, origin_y) in zip(frame_names, frames)]
+    }
+    with open(os.path.join(folder_name, data['name']+'_atlas.json'), 'w') as file:
+        json.dump(sidecar, file, indent=1)
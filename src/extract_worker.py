@@ -0,0 +1,45 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+from src.romhandler import RomHandlerParent
+import traceback
+
+class ExtractionCancelled(Exception):
+    pass
+
+class ExtractWorkerSignals(QObject):
+    progress = Signal(int, int, int) # spritemaps, hitboxes, extended spritemaps parsed so far
+    finished = Signal(object) # the extracted data
+    failed = Signal(str)
+    cancelled = Signal()
+
+class ExtractWorker(QRunnable):
+    '''Loads a ROM and runs an extraction function (extract_enemy or extract_generic) on it off the GUI thread'''
+    def __init__(self, romFileName, extract, args):
+        super().__init__()
+        self.romFileName = romFileName
+        self.extract = extract
+        self.args = args
+        self.signals = ExtractWorkerSignals()
+        self.isCancelled = False
+
+    def cancel(self):
+        self.isCancelled = True
+
+    def reportProgress(self, spritemaps, hitboxes, ext_spritemaps):
+        # called by the extraction after each item, this is where it stops if cancelled
+        if self.isCancelled:
+            raise ExtractionCancelled()
+        self.signals.progress.emit(spritemaps, hitboxes, ext_spritemaps)
+
+    def run(self):
+        try:
+            rom = RomHandlerParent(self.romFileName)
+            data = self.extract(rom, *self.args, progress=self.reportProgress)
+        except ExtractionCancelled:
+            self.signals.cancelled.emit()
+        except Exception:
+            self.signals.failed.emit(traceback.format_exc())
+        else:
+            if self.isCancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(data)
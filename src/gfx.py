@@ -1,11 +1,34 @@
 import numpy as np
 from PySide6.QtGui import QImage
 
+# The default canvas covers everything a spritemap entry can draw: x from -256 to 255 and y from -128 to 127, plus a 16x16 tile
+CANVAS_HALF_WIDTH = 0x100 + 16
+CANVAS_HALF_HEIGHT = 0x80 + 16
+
+def new_canvas(half_width=CANVAS_HALF_WIDTH, half_height=CANVAS_HALF_HEIGHT):
+    '''Returns an empty (transparent) canvas, an index buffer with (0, 0) at its center, from -half_width to half_width
+    and -half_height to half_height
+
+    It is signed: pixels of negative palettes are negative, drawn as transparency but still part of the bounding box.
+    '''
+    return np.zeros((2*half_height, 2*half_width), dtype=np.int16)
+
+def canvas_reach(tilemaps, x=0, y=0):
+    '''Returns the (half width, half height) of the smallest canvas that fits the spritemap entries moved by (x, y)'''
+    (half_width, half_height) = (0, 0)
+    for tilemap in tilemaps:
+        size = 16 if tilemap['big'] else 8
+        half_width = max(half_width, -(tilemap['x']+x), tilemap['x']+x+size)
+        half_height = max(half_height, -(tilemap['y']+y), tilemap['y']+y+size)
+    return (half_width, half_height)
+
 ''' Modified From SpriteSomething (https://github.com/Artheau/SpriteSomething) '''
-def add_to_canvas_from_spritemap(canvas, tilemaps, graphics, priority_filter=None):
+def add_to_canvas_from_spritemap(canvas, tilemaps, tiles, priority_filter=None):
     # expects:
+    #  a canvas from new_canvas()
     #  a dictionary of spritemap entries
-    #  a bytearray or list of bytes of 4bpp graphics
+    #  a TileCache of the 4bpp graphics
+    # pixels outside of the canvas are clipped
 
     for tilemap in reversed(tilemaps):
         x_offset = tilemap['x']
@@ -18,16 +41,23 @@ def add_to_canvas_from_spritemap(canvas, tilemaps, graphics, priority_filter=Non
         v_flip = tilemap['v_flip']
 
         def draw_tile_to_canvas(new_x_offset, new_y_offset, new_index):
-            if new_index < 0 or new_index*32 > len(graphics)-32: # check for oob
+            tile_to_write = tiles.get(new_index, h_flip, v_flip)
+            if tile_to_write is None: # check for oob
                 return
-            tile_to_write = convert_tile_from_bitplanes(graphics[new_index*32:new_index*32+32])
-            if h_flip:
-                tile_to_write = np.fliplr(tile_to_write)
-            if v_flip:
-                tile_to_write = np.flipud(tile_to_write)
-            for (i, j), value in np.ndenumerate(tile_to_write):
-                if value != 0:  # if not transparent
-                    canvas[(new_x_offset + j, new_y_offset + i)] = palette * 0x10 + int(value)
+
+            # clip the tile to the canvas
+            (height, width) = canvas.shape
+            left = new_x_offset + width//2
+            top = new_y_offset + height//2
+            if left >= width or top >= height or left <= -8 or top <= -8:
+                return
+            tile_to_write = tile_to_write[max(0, -top):height-top, max(0, -left):width-left]
+            left = max(0, left)
+            top = max(0, top)
+
+            region = canvas[top:top+tile_to_write.shape[0], left:left+tile_to_write.shape[1]]
+            mask = tile_to_write != 0 # if not transparent
+            region[mask] = palette * 0x10 + tile_to_write[mask].astype(np.int16)
 
         if priority_filter != None and priority != priority_filter:
             break
@@ -46,32 +76,45 @@ def add_to_canvas_from_spritemap(canvas, tilemaps, graphics, priority_filter=Non
 
 def bounding_box(canvas):
     '''Returns the minimum bounding box centered at the middle without cropping a single pixel'''
-    if canvas.keys():
-        x_min = min([x for (x, y) in canvas.keys()])
-        x_max = max([x for (x, y) in canvas.keys()]) + 1
-        y_min = min([y for (x, y) in canvas.keys()])
-        y_max = max([y for (x, y) in canvas.keys()]) + 1
+    rows = np.flatnonzero(canvas.any(axis=1))
+    columns = np.flatnonzero(canvas.any(axis=0))
+    if rows.size > 0:
+        (origin_x, origin_y) = (canvas.shape[1]//2, canvas.shape[0]//2)
+        x_min = int(columns[0]) - origin_x
+        x_max = int(columns[-1]) - origin_x + 1
+        y_min = int(rows[0]) - origin_y
+        y_max = int(rows[-1]) - origin_y + 1
 
         return (max(abs(x_min), abs(x_max)), max(abs(y_min), abs(y_max)))
     else:
         return (0, 0)
 
+def crop_canvas(canvas, left, top, right, bottom):
+    '''Returns a copy of a box of the canvas, the parts of the box outside of the canvas are transparent'''
+    buffer = np.zeros((max(0, bottom-top), max(0, right-left)), dtype=canvas.dtype)
+    (origin_x, origin_y) = (canvas.shape[1]//2, canvas.shape[0]//2)
+    cropped = canvas[max(0, top+origin_y):max(0, bottom+origin_y), max(0, left+origin_x):max(0, right+origin_x)]
+    x_start = max(0, -(left+origin_x))
+    y_start = max(0, -(top+origin_y))
+    cropped = cropped[:buffer.shape[0]-y_start, :buffer.shape[1]-x_start]
+    buffer[y_start:y_start+cropped.shape[0], x_start:x_start+cropped.shape[1]] = cropped
+    return buffer
+
 def to_qimage(canvas, palette, left, top, right, bottom):
-    '''Returns a QImage cropped by a bounding box'''
-    image = QImage(right-left, bottom-top, QImage.Format_Indexed8)
-    image.fill(0) # fill image with transparency
+    '''Returns a QImage cropped by a bounding box, uploaded from one index buffer'''
+    if right <= left or bottom <= top:
+        image = QImage(max(0, right-left), max(0, bottom-top), QImage.Format_Indexed8)
+        image.setColorTable(palette)
+        return image
 
-    # add the palette
-    image.setColorTable(palette)
+    buffer = crop_canvas(canvas, left, top, right, bottom)
+    clear_out_of_palette(buffer, palette)
 
-    # add the pixels
-    if canvas.keys():
-        for (i, j), value in canvas.items():
-            if value < 0 or value >= len(palette): # check if color is oob, transparency if so
-                value = 0
-            image.setPixel(i-left, j-top, value)
+    return indexed_image_from_buffer(buffer, palette)
 
-    return image
+def clear_out_of_palette(buffer, palette):
+    '''Makes the colors out of the palette (negative ones too, and past an 8-bit index) transparency, in place'''
+    buffer[(buffer < 0) | (buffer >= min(len(palette), 0x100))] = 0
 
 def convert_tile_from_bitplanes(raw_tile):
     # See https://snes.nesdev.org/wiki/Tiles for the format
@@ -91,26 +134,99 @@ def convert_tile_from_bitplanes(raw_tile):
     returnvalue = fixed_bits.reshape(8, 8)
     return returnvalue
 
-def convert_4bpp_to_image(raw, palette):
-    raveled = np.ravel(np.concatenate([np.concatenate([convert_tile_from_bitplanes(raw[(i+j)*0x20:(i+j+1)*0x20]) for i in range(0x10)], 1) for j in range(0, len(raw)//0x20, 0x10)], 0))
+def convert_tiles_from_bitplanes(raw):
+    '''Decodes a whole 4bpp graphics blob at once, returns an (N, 8, 8) array of tiles'''
+    # the same process as convert_tile_from_bitplanes(), just with an extra axis for the tiles
+    # a trailing partial tile is ignored
+    tile_count = len(raw)//32
+    raw_tiles = np.frombuffer(bytes(raw[:tile_count*32]), dtype=np.uint8).reshape(tile_count, 32)
+
+    # (N, low/high bitplanes, row, bitplane in the pair) -> (N, row, bitplane)
+    tile = raw_tiles.reshape(tile_count, 2, 8, 2).transpose(0, 2, 1, 3).reshape(tile_count, 8, 4, 1)
+
+    tile_bits = np.unpackbits(tile, axis=3, bitorder='big') # decompose the bitplanes to rows
+    fixed_bits = np.packbits(tile_bits, axis=2, bitorder='little') # combine the bitplanes
+    return fixed_bits.reshape(tile_count, 8, 8)
+
+class TileCache():
+    '''Decoded tiles of a 4bpp graphics blob, along with their flipped versions'''
+    def __init__(self, graphics):
+        tiles = convert_tiles_from_bitplanes(graphics)
+
+        # indexed by h_flip | v_flip << 1, the flipped tiles are views, not copies
+        self._flipped = (tiles, tiles[:, :, ::-1], tiles[:, ::-1, :], tiles[:, ::-1, ::-1])
 
-    image = QImage(raveled, 0x80, 8*len(raw)//0x200, QImage.Format_Indexed8)
+    def __len__(self):
+        return len(self._flipped[0])
+
+    @property
+    def tiles(self):
+        return self._flipped[0]
+
+    def get(self, index, h_flip=False, v_flip=False):
+        '''Returns an 8x8 tile, or None if the index is out of bounds'''
+        if index < 0 or index >= len(self):
+            return None
+        return self._flipped[bool(h_flip) | bool(v_flip) << 1][index]
+
+def indexed_image_from_buffer(buffer, palette):
+    '''Returns an indexed QImage with a copy of a 2D uint8 buffer'''
+    buffer = np.ascontiguousarray(buffer, dtype=np.uint8)
+    (height, width) = buffer.shape
+
+    # passing the stride (bytesPerLine) lets rows not be 32-bit aligned;
+    # the QImage only borrows the buffer, so copy it before the buffer goes away
+    image = QImage(buffer.data, width, height, width, QImage.Format_Indexed8).copy()
     image.setColorTable(palette)
     return image
 
+def convert_tiles_to_image(tiles, palette, first=0, count=None):
+    '''Lays out the tiles of a TileCache (count of them from first, or all) as a sheet 16 tiles wide'''
+    selected = tiles.tiles[first:] if count == None else tiles.tiles[first:first+count]
+    row_count = (len(selected)+0xF)//0x10
+
+    # pad the last row with transparent tiles
+    padded = np.zeros((row_count*0x10, 8, 8), dtype=np.uint8)
+    padded[:len(selected)] = selected
+
+    sheet = padded.reshape(row_count, 0x10, 8, 8).transpose(0, 2, 1, 3).reshape(row_count*8, 0x80)
+    return indexed_image_from_buffer(sheet, palette)
+
+def convert_4bpp_to_image(raw, palette):
+    return convert_tiles_to_image(TileCache(raw), palette)
+
 def convert_to_4bpp(image):
     '''Converts a QImage to SNES 4bpp tiles as bytearray'''
     if image.format() != QImage.Format_Indexed8:
         raise AssertionError('Format must be indexed color')
 
-    output = bytearray()
+    width = image.width()
+    height = image.height()
+
+    # scanlines are padded to bytesPerLine
+    pixels = np.frombuffer(image.constBits(), dtype=np.uint8, count=image.bytesPerLine()*height)
+    pixels = pixels.reshape(height, image.bytesPerLine())[:, :width]
+
+    if pixels.size > 0 and pixels.max() > 0xF:
+        raise AssertionError(f'Color index {pixels.max()} is out of range, 4bpp graphics can only use colors 0 to 15')
+
+    # partial tiles at the edges are padded with color 0
+    row_count = (height+7)//8
+    column_count = (width+7)//8
+    padded = np.zeros((row_count*8, column_count*8), dtype=np.uint8)
+    padded[:height, :width] = pixels
 
-    for y in range(0, image.height(), 8):
-        for x in range(0, image.width(), 8):
-            tile = image.copy(x, y, 8, 8)
-            output.extend(convert_indexed_tile_to_bitplanes(tile.constBits()))
+    return convert_tiles_to_bitplanes(padded.reshape(row_count, 8, column_count, 8).transpose(0, 2, 1, 3).reshape(-1, 8, 8))
 
-    return output
+def convert_tiles_to_bitplanes(tiles):
+    '''Encodes an (N, 8, 8) array of tiles as 4bpp graphics, the inverse of convert_tiles_from_bitplanes()'''
+    tile_count = len(tiles)
+    fixed_bits = tiles.reshape(tile_count, 8, 1, 8)
+    tile_bits = np.unpackbits(fixed_bits, axis=2, bitorder='little')[:, :, :4] # decompose the pixels to bitplanes
+    tile = np.packbits(tile_bits, axis=3, bitorder='big') # (N, row, bitplane, 1)
+
+    # (N, row, bitplane) -> (N, low/high bitplanes, row, bitplane in the pair)
+    return bytearray(tile.reshape(tile_count, 8, 2, 2).transpose(0, 2, 1, 3).tobytes())
 
 def convert_indexed_tile_to_bitplanes(indexed_tile):
     # this should literally just be the inverse of
@@ -122,3 +238,42 @@ def convert_indexed_tile_to_bitplanes(indexed_tile):
     low_bitplanes = np.ravel(tile[:, 0, 0:2])
     high_bitplanes = np.ravel(tile[:, 0, 2:4])
     return np.append(low_bitplanes, high_bitplanes)
+
+def _draw_with_pixel_dict(tilemap, tiles):
+    '''The pixels one spritemap entry draws as a {(x, y): color} dict, the way the canvas used to be, to check against'''
+    pixels = {}
+    size = 16 if tilemap['big'] else 8
+    for tile_y in range(0, size, 8):
+        for tile_x in range(0, size, 8):
+            tile = tiles.get(tilemap['tile'] + tile_y*2 + tile_x//8, tilemap['h_flip'], tilemap['v_flip'])
+            x = tilemap['x'] + (size-8-tile_x if tilemap['h_flip'] else tile_x)
+            y = tilemap['y'] + (size-8-tile_y if tilemap['v_flip'] else tile_y)
+            for (i, j), value in np.ndenumerate(tile):
+                if value != 0:
+                    pixels[(x + j, y + i)] = tilemap['palette']*0x10 + int(value)
+    return pixels
+
+def main():
+    # draws single entries at the extremes of the OAM coordinates, on the default canvas and on a small one that clips them
+    rng = np.random.default_rng(0)
+    tiles = TileCache(bytes(rng.integers(0, 0x100, 0x20*32, dtype=np.uint8)))
+    for x in (-256, -255, -249, -8, 0, 248, 249, 255):
+        for y in (-128, -127, -121, 0, 120, 121, 127):
+            for big in (False, True):
+                for h_flip in (False, True):
+                    for v_flip in (False, True):
+                        tilemap = {'x': x, 'y': y, 'big': big, 'tile': 0, 'palette': 1, 'bg_priority': 2, 'h_flip': h_flip, 'v_flip': v_flip}
+                        expected = _draw_with_pixel_dict(tilemap, tiles)
+                        for (half_width, half_height) in ((CANVAS_HALF_WIDTH, CANVAS_HALF_HEIGHT), (252, 124)):
+                            canvas = new_canvas(half_width, half_height)
+                            add_to_canvas_from_spritemap(canvas, [tilemap], tiles)
+                            inside = {(i, j): value for (i, j), value in expected.items() if -half_width <= i < half_width and -half_height <= j < half_height}
+                            drawn = {(int(i) - half_width, int(j) - half_height): int(canvas[j, i]) for j, i in zip(*np.nonzero(canvas))}
+                            if drawn != inside:
+                                raise AssertionError(f'{tilemap} drawn wrong on a {2*half_width}x{2*half_height} canvas')
+                            if half_width == CANVAS_HALF_WIDTH and inside != expected:
+                                raise AssertionError(f'{tilemap} doesn\'t fit the default canvas')
+    print('canvas ok')
+
+if __name__ == '__main__':
+    main()
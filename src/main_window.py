@@ -1,18 +1,35 @@
-from PySide6.QtCore import Qt, Signal, Slot
+from PySide6.QtCore import Qt, QThreadPool, QTimer, Signal, Slot
 from PySide6.QtGui import QIcon
 from PySide6.QtWidgets import *
 
 from src.extract_dialog import ExtractDialog
 from src.spritemap_editor import SpritemapEditorWidget
-from src.extract_export import extract_generic, extract_enemy, export_to_asm, export_to_png
-from src.romhandler import RomHandlerParent
+from src.extract_export import extract_generic, extract_enemy, export_to_asm, export_to_png, export_to_png_atlas
+from src.extract_worker import ExtractWorker
+from src.animation_player import AnimationPlayer
+from src.project_file import LazySpritemaps, load_project, save_project
+from src.autosave import DirtyTracker, JournalWriter, discard_journal, has_journal, recover
+from functools import partial
 import base64, bz2, json, math, sys
 
+PROJECT_FILE_FILTER = 'Projects (*.json *.smproj);;JSON files (*.json);;Binary projects (*.smproj)'
+SAVE_FILE_FILTER = 'JSON files (*.json);;Binary projects (*.smproj)'
+AUTOSAVE_INTERVAL = 30000 # ms
+
 class DataLeaf(QTreeWidgetItem):
-    def __init__(self, parent, data):
-        super().__init__(parent, [data['name']])
+    def __init__(self, parent, data=None, name=None, loader=None):
+        '''Either data, or its name and a function returning it when it's first needed'''
+        super().__init__(parent, [data['name'] if data != None else name])
+
+        self._datas = data
+        self.loader = loader
+        self.uid = None # ID of spritemaps in the autosave journal
 
-        self.datas = data
+    @property
+    def datas(self):
+        if self._datas == None:
+            self._datas = self.loader()
+        return self._datas
 
 class DataTree(QTreeWidget):
     def __init__(self, parent):
@@ -37,14 +54,17 @@ class DataTree(QTreeWidget):
                 if item is self.parent.spritemaps or item.parent() is self.parent.spritemaps:
                     item = DataLeaf(self.parent.spritemaps, pastedData)
                     item.setFlags(item.flags() | Qt.ItemIsEditable)
+                    self.parent.addedSpritemapLeaf(item)
                     self.setCurrentItem(item)
                 elif item is self.parent.ext_hitboxes or item.parent() is self.parent.ext_hitboxes:
                     item = DataLeaf(self.parent.ext_hitboxes, pastedData)
                     item.setFlags(item.flags() | Qt.ItemIsEditable)
+                    self.parent.treeEdited(self.parent.ext_hitboxes)
                     self.setCurrentItem(item)
                 elif item is self.parent.ext_spritemaps or item.parent() is self.parent.ext_spritemaps:
                     item = DataLeaf(self.parent.ext_spritemaps, pastedData)
                     item.setFlags(item.flags() | Qt.ItemIsEditable)
+                    self.parent.treeEdited(self.parent.ext_spritemaps)
                     self.setCurrentItem(item)
         
         # Delete
@@ -55,8 +75,11 @@ class MainWindow(QMainWindow):
     def __init__(self, fp=None, parent=None):
         super().__init__(parent)
 
+        self.dirty = DirtyTracker()
+        self.editedLeaf = None
+        recovered = False
         if fp != None:
-            self.data = json.load(open(fp, 'r'))
+            (self.data, recovered) = self.loadProjectFile(fp)
             self.updateOldData()
         else:
             self.data = data = {
@@ -116,8 +139,12 @@ class MainWindow(QMainWindow):
         fileMenu.addSeparator()
         exportASMAction = fileMenu.addAction('Export ASM...')
         exportASMAction.triggered.connect(self.exportASM)
+        exportCombinedASMAction = fileMenu.addAction('Export ASM (single file)...')
+        exportCombinedASMAction.triggered.connect(self.exportCombinedASM)
         exportPNGAction = fileMenu.addAction('Export PNG...')
         exportPNGAction.triggered.connect(self.exportPNG)
+        exportPNGAtlasAction = fileMenu.addAction('Export PNG atlas...')
+        exportPNGAtlasAction.triggered.connect(self.exportPNGAtlas)
         fileMenu.addSeparator()
         exitAction = fileMenu.addAction('Exit')
         exitAction.setShortcut('Ctrl+Q')
@@ -133,9 +160,15 @@ class MainWindow(QMainWindow):
         vFlipAction.setShortcut('Shift+V')
         vFlipAction.triggered.connect(self.vFlipTriggered)
 
+        viewMenu = QMenu('View')
+        animationAction = viewMenu.addAction('Play animation...')
+        animationAction.setShortcut('Ctrl+P')
+        animationAction.triggered.connect(self.openAnimationPlayer)
+
         self.menuBar = self.menuBar()
         self.menuBar.addMenu(fileMenu)
         self.menuBar.addMenu(editMenu)
+        self.menuBar.addMenu(viewMenu)
 
         left = QVBoxLayout()
         left.addLayout(editDataRow)
@@ -162,8 +195,21 @@ class MainWindow(QMainWindow):
         stackedWidgetDock.setFeatures(QDockWidget.DockWidgetMovable)
         self.addDockWidget(Qt.RightDockWidgetArea, stackedWidgetDock)
 
+        self.cacheLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.cacheLabel)
+        self.updateCacheLabel()
+
         self.dataTree.currentItemChanged.connect(self.selectItem)
         self.dataTree.itemChanged.connect(self.renameItem)
+        self.spritemapEditor.edited.connect(self.editorEdited)
+
+        self.autosavePool = QThreadPool(self)
+        self.autosavePool.setMaxThreadCount(1) # so the records are written in order
+        self.autosaveTimer = QTimer(self)
+        self.autosaveTimer.timeout.connect(self.autosave)
+        self.autosaveTimer.start(AUTOSAVE_INTERVAL)
+        if recovered:
+            self.recoveredFromJournal()
 
     @Slot()
     def openExtractDialog(self):
@@ -171,8 +217,6 @@ class MainWindow(QMainWindow):
 
     @Slot()
     def extractDialogAccepted(self):
-        rom = RomHandlerParent(self.extractDialog.romInput.text())
-
         def int_or_none(text):
             return None if text == '' else int(text, 16)
 
@@ -187,7 +231,8 @@ class MainWindow(QMainWindow):
                 ext_spritemap_end = int_or_none(self.extractDialog.enemyExtSpritemapEndInput.text())
                 name = self.extractDialog.enemyNameInput.text()
 
-                self.data = extract_enemy(rom, enemy_id, (spritemap_start, spritemap_end), (ext_hitbox_start, ext_hitbox_end), (ext_spritemap_start, ext_spritemap_end), name)
+                extract = extract_enemy
+                args = (enemy_id, (spritemap_start, spritemap_end), (ext_hitbox_start, ext_hitbox_end), (ext_spritemap_start, ext_spritemap_end), name)
             case 1:
                 gfx_addr = int(self.extractDialog.genericGFXAddrInput.text(), 16)
                 gfx_size = self.extractDialog.genericGFXSizeInput.value()
@@ -204,22 +249,70 @@ class MainWindow(QMainWindow):
                 ext_spritemap_end = int_or_none(self.extractDialog.genericExtSpritemapEndInput.text())
                 name = self.extractDialog.genericNameInput.text()
 
-                self.data = extract_generic(rom, gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pal_offset, (spritemap_start, spritemap_end), (ext_hitbox_start, ext_hitbox_end), (ext_spritemap_start, ext_spritemap_end), name, compressed_gfx)
-
+                extract = extract_generic
+                args = (gfx_addr, gfx_size, gfx_offset, pal_addr, pal_count, pal_offset, (spritemap_start, spritemap_end), (ext_hitbox_start, ext_hitbox_end), (ext_spritemap_start, ext_spritemap_end), name, compressed_gfx)
+
+        # extract in the background, the long or autodetected ranges of big hacks can take a while
+        self.extractWorker = ExtractWorker(self.extractDialog.romInput.text(), extract, args)
+        self.extractProgressDialog = QProgressDialog('Importing from ROM...', 'Cancel', 0, 0, self)
+        self.extractProgressDialog.setWindowModality(Qt.WindowModal)
+        self.extractProgressDialog.setMinimumDuration(500)
+        self.extractProgressDialog.canceled.connect(self.extractWorker.cancel)
+        self.extractWorker.signals.progress.connect(self.extractProgress)
+        self.extractWorker.signals.finished.connect(self.extractFinished)
+        self.extractWorker.signals.failed.connect(self.extractFailed)
+        self.extractWorker.signals.cancelled.connect(self.extractProgressDialog.reset)
+        QThreadPool.globalInstance().start(self.extractWorker)
+
+    @Slot(int, int, int)
+    def extractProgress(self, spritemaps, hitboxes, ext_spritemaps):
+        self.extractProgressDialog.setLabelText(f'Importing from ROM...\n{spritemaps} spritemaps, {hitboxes} extended hitboxes, {ext_spritemaps} extended spritemaps')
+
+    @Slot(object)
+    def extractFinished(self, data):
+        self.extractProgressDialog.reset()
+        self.data = data
         self.updateDataTree()
         self.stackedWidget.setCurrentIndex(0)
         self.spritemapEditor.loadData(self.data)
+        # the import isn't the project that was open, so it has no file (and no journal) until it's saved
+        self.discardJournal()
+        self.fileNameToSave = None
+        self.dirty.mark_all(leaf.uid for leaf in self.spritemapLeaves())
+
+    @Slot(str)
+    def extractFailed(self, error):
+        self.extractProgressDialog.reset()
+        QMessageBox.critical(self, 'Import from ROM', f'Importing failed:\n{error}')
 
     @Slot()
     def openFile(self):
-        fileName = QFileDialog.getOpenFileName(self, filter='JSON files (*.json)')[0]
+        fileName = QFileDialog.getOpenFileName(self, filter=PROJECT_FILE_FILTER)[0]
         if fileName != '':
-            self.data = json.load(open(fileName, 'r'))
+            (self.data, recovered) = self.loadProjectFile(fileName)
             self.updateOldData()
             self.updateDataTree()
             self.stackedWidget.setCurrentIndex(0)
             self.spritemapEditor.loadData(self.data)
             self.fileNameToSave = fileName
+            self.dirty.clear()
+            if recovered:
+                self.recoveredFromJournal()
+
+    def loadProjectFile(self, fp):
+        '''Returns the project and whether unsaved changes were recovered from its autosave journal'''
+        if has_journal(fp):
+            answer = QMessageBox.question(self, 'Recover unsaved changes',
+                f'{fp} has autosaved changes that were never saved, probably because the editor crashed.\nRecover them?')
+            if answer == QMessageBox.Yes:
+                return (recover(fp), True)
+            discard_journal(fp)
+        return (load_project(fp, lazy=True), False)
+
+    def recoveredFromJournal(self):
+        # the spritemaps got new IDs, replace the journal with all of the recovered project
+        self.dirty.mark_all(leaf.uid for leaf in self.spritemapLeaves())
+        self.autosave(compact=True)
 
     @Slot()
     def saveFile(self):
@@ -227,16 +320,75 @@ class MainWindow(QMainWindow):
             self.saveFileAs()
         else:
             self.updateData()
-            json.dump(self.data, open(self.fileNameToSave, 'w'), indent=1)
+            save_project(self.data, self.fileNameToSave)
+            self.saved()
 
     @Slot()
     def saveFileAs(self):
         fp = self.fileNameToSave if self.fileNameToSave != None else self.data['name']+'.json'
-        fileName = QFileDialog.getSaveFileName(self, dir=fp, filter='JSON files (*.json)')[0]
+        fileName = QFileDialog.getSaveFileName(self, dir=fp, filter=SAVE_FILE_FILTER)[0]
         if fileName != '':
             self.updateData()
-            json.dump(self.data, open(fileName, 'w'), indent=1)
+            save_project(self.data, fileName)
+            self.discardJournal()
             self.fileNameToSave = fileName
+            self.saved()
+
+    def saved(self):
+        # everything is in the project file now, the spritemap IDs are their new indices
+        self.discardJournal()
+        for i, leaf in enumerate(self.spritemapLeaves()):
+            leaf.uid = str(i)
+        self.nextUid = self.spritemaps.childCount()
+        self.dirty.clear()
+
+    @Slot()
+    def autosave(self, compact=False):
+        '''Appends the parts changed since the last autosave to the journal, or replaces it with them if compact
+
+        Only the copy of the changed parts is made here, it gets written in the background.
+        '''
+        if self.fileNameToSave != None and (self.dirty or compact):
+            self.updateExtData()
+            leaves = {leaf.uid: leaf for leaf in self.spritemapLeaves()}
+            record = self.dirty.take_record(self.data, list(leaves.keys()), lambda uid: leaves[uid].datas)
+            self.autosavePool.start(JournalWriter(self.fileNameToSave, record, replace=compact))
+
+    def discardJournal(self):
+        '''Deletes the journal of the project file, once the autosaves still being written are done'''
+        self.autosavePool.waitForDone()
+        if self.fileNameToSave != None:
+            discard_journal(self.fileNameToSave)
+
+    @Slot(str)
+    def editorEdited(self, section):
+        if section == 'spritemap':
+            if self.editedLeaf != None:
+                self.dirty.mark_spritemap(self.editedLeaf.uid)
+        else:
+            self.dirty.mark(section)
+            self.updateCacheLabel() # gfx and palette changes invalidate the cached pixmaps
+
+    def updateCacheLabel(self):
+        self.cacheLabel.setText(f'Sprite pixmap cache: {self.spritemapEditor.pixmapCache}')
+
+    def treeEdited(self, parent):
+        '''Marks the list of parent as changed'''
+        if parent is self.spritemaps:
+            self.dirty.mark('order')
+        elif parent is self.ext_hitboxes:
+            self.dirty.mark('ext_hitboxes')
+        elif parent is self.ext_spritemaps:
+            self.dirty.mark('ext_spritemaps')
+
+    def addedSpritemapLeaf(self, item):
+        item.uid = str(self.nextUid)
+        self.nextUid += 1
+        self.dirty.mark_spritemap(item.uid)
+        self.treeEdited(self.spritemaps)
+
+    def spritemapLeaves(self):
+        return [self.spritemaps.child(i) for i in range(self.spritemaps.childCount())]
 
     @Slot()
     def exportASM(self):
@@ -245,6 +397,13 @@ class MainWindow(QMainWindow):
             self.updateData()
             export_to_asm(self.data, directory)
 
+    @Slot()
+    def exportCombinedASM(self):
+        directory = QFileDialog.getExistingDirectory(self, 'Select folder to put the ASM file (with the GFX and PAL in it) in')
+        if directory != '':
+            self.updateData()
+            export_to_asm(self.data, directory, combined=True)
+
     @Slot()
     def exportPNG(self):
         directory = QFileDialog.getExistingDirectory(self, 'Select folder to put PNG files in')
@@ -252,6 +411,18 @@ class MainWindow(QMainWindow):
             self.updateData()
             export_to_png(self.data, directory)
 
+    @Slot()
+    def exportPNGAtlas(self):
+        directory = QFileDialog.getExistingDirectory(self, 'Select folder to put the PNG atlas and its JSON file in')
+        if directory != '':
+            self.updateData()
+            export_to_png_atlas(self.data, directory)
+
+    @Slot()
+    def openAnimationPlayer(self):
+        self.updateData()
+        AnimationPlayer(self, self.data).exec()
+
     def updateOldData(self):
         ''' Update data from previous versions'''
 
@@ -263,9 +434,12 @@ class MainWindow(QMainWindow):
             self.data['ext_spritemaps'] = []
 
     def updateData(self):
-        self.data['spritemaps'] = []
-        for i in range(self.spritemaps.childCount()):
-            self.data['spritemaps'].append(self.spritemaps.child(i).datas)
+        self.data['spritemaps'] = [leaf.datas for leaf in self.spritemapLeaves()]
+        self.updateExtData()
+
+    def updateExtData(self):
+        self.data['ext_hitboxes'] = [self.ext_hitboxes.child(i).datas for i in range(self.ext_hitboxes.childCount())]
+        self.data['ext_spritemaps'] = [self.ext_spritemaps.child(i).datas for i in range(self.ext_spritemaps.childCount())]
 
     def updateDataTree(self):
         self.initialized = False
@@ -277,9 +451,19 @@ class MainWindow(QMainWindow):
 
         self.spritemaps = QTreeWidgetItem(self.dataGroup, ['Spritemaps'])
         self.spritemaps.setExpanded(True)
-        for spritemap in self.data['spritemaps']:
-            item = DataLeaf(self.spritemaps, spritemap)
+        spritemaps = self.data['spritemaps']
+        items = []
+        for i in range(len(spritemaps)):
+            if isinstance(spritemaps, LazySpritemaps):
+                item = DataLeaf(None, name=spritemaps.name(i), loader=partial(spritemaps.__getitem__, i))
+            else:
+                item = DataLeaf(None, spritemaps[i])
             item.setFlags(item.flags() | Qt.ItemIsEditable)
+            item.uid = str(i)
+            items.append(item)
+        self.spritemaps.addChildren(items) # adding them all at once is much faster for big projects
+        self.nextUid = len(items)
+        self.editedLeaf = None
 
         self.ext_hitboxes = QTreeWidgetItem(self.dataGroup, ['Extended hitboxes'])
         self.ext_hitboxes.setExpanded(True)
@@ -300,7 +484,10 @@ class MainWindow(QMainWindow):
         if self.dataTree.currentItem() != None:
             if self.dataTree.currentItem().parent() is self.spritemaps:
                 self.stackedWidget.setCurrentIndex(1)
-                self.spritemapEditor.updateSpritemapChanged(self.dataTree.currentItem().datas)
+                self.spritemapEditor.flushMovedSprites() # so they're marked as edits of the previous spritemap
+                self.editedLeaf = self.dataTree.currentItem()
+                self.spritemapEditor.updateSpritemapChanged(self.editedLeaf.datas)
+                self.updateCacheLabel()
             else:
                 self.stackedWidget.setCurrentIndex(0)
 
@@ -309,7 +496,9 @@ class MainWindow(QMainWindow):
         if self.initialized and column == 0:
             if item is self.dataGroup:
                 self.data['name'] = item.text(0)
-            elif item.parent() is self.spritemaps:
+                self.dirty.mark('meta')
+            elif item.parent() is self.spritemaps and item.text(0) != item.datas['name']: # itemChanged is also emitted for flag changes
+                self.updateExtData()
                 for h in self.data['ext_hitboxes']:
                     if h['spritemap'] == item.datas['name']:
                         h['spritemap'] = item.text(0)
@@ -318,6 +507,15 @@ class MainWindow(QMainWindow):
                         if s['spritemap'] == item.datas['name']:
                             s['spritemap'] = item.text(0)
                 item.datas['name'] = item.text(0)
+                self.dirty.mark_spritemap(item.uid)
+                self.dirty.mark('ext_hitboxes')
+                self.dirty.mark('ext_spritemaps')
+            elif item.parent() is self.ext_hitboxes and item.text(0) != item.datas['name']:
+                item.datas['name'] = item.text(0)
+                self.dirty.mark('ext_hitboxes')
+            elif item.parent() is self.ext_spritemaps and item.text(0) != item.datas['name']:
+                item.datas['name'] = item.text(0)
+                self.dirty.mark('ext_spritemaps')
 
     @Slot()
     def newClicked(self):
@@ -329,6 +527,7 @@ class MainWindow(QMainWindow):
                 }
                 item = DataLeaf(self.spritemaps, data)
                 item.setFlags(item.flags() | Qt.ItemIsEditable)
+                self.addedSpritemapLeaf(item)
                 self.dataTree.setCurrentItem(item)
             elif self.dataTree.currentItem() is self.ext_hitboxes or self.dataTree.currentItem().parent() is self.ext_hitboxes:
                 data = {
@@ -338,6 +537,7 @@ class MainWindow(QMainWindow):
                 }
                 item = DataLeaf(self.ext_hitboxes, data)
                 item.setFlags(item.flags() | Qt.ItemIsEditable)
+                self.treeEdited(self.ext_hitboxes)
                 self.dataTree.setCurrentItem(item)
             elif self.dataTree.currentItem() is self.ext_spritemaps or self.dataTree.currentItem().parent() is self.ext_spritemaps:
                 data = {
@@ -346,6 +546,7 @@ class MainWindow(QMainWindow):
                 }
                 item = DataLeaf(self.ext_spritemaps, data)
                 item.setFlags(item.flags() | Qt.ItemIsEditable)
+                self.treeEdited(self.ext_spritemaps)
                 self.dataTree.setCurrentItem(item)
 
     @Slot()
@@ -353,6 +554,7 @@ class MainWindow(QMainWindow):
         if self.dataTree.currentItem() != None:
             item = self.dataTree.currentItem()
             if item.parent() is self.spritemaps:
+                self.updateExtData()
                 for h in self.data['ext_hitboxes']:
                     if h['spritemap'] == item.datas['name']:
                         h['spritemap'] = None
@@ -360,8 +562,14 @@ class MainWindow(QMainWindow):
                     for s in e['ext_spritemap']:
                         if s['spritemap'] == item.datas['name']:
                             s['spritemap'] = None
+                if item is self.editedLeaf:
+                    self.editedLeaf = None
                 item.parent().removeChild(item)
+                self.treeEdited(self.spritemaps)
+                self.dirty.mark('ext_hitboxes')
+                self.dirty.mark('ext_spritemaps')
             elif item.parent() is self.ext_hitboxes or item.parent() is self.ext_spritemaps:
+                self.treeEdited(item.parent())
                 item.parent().removeChild(item)
 
     @Slot()
@@ -374,6 +582,7 @@ class MainWindow(QMainWindow):
                 if index > 0:
                     parent.removeChild(item)
                     parent.insertChild(index-1, item)
+                    self.treeEdited(parent)
                     self.dataTree.setCurrentItem(item)
 
     @Slot()
@@ -386,6 +595,7 @@ class MainWindow(QMainWindow):
                 if index < parent.childCount()-1:
                     parent.removeChild(item)
                     parent.insertChild(index+1, item)
+                    self.treeEdited(parent)
                     self.dataTree.setCurrentItem(item)
 
     @Slot()
@@ -0,0 +1,239 @@
+from src.extract_export import decode_spritemap_entry, decode_spritemap_entries, encode_spritemap_entry
+from collections.abc import Sequence
+import base64, json, struct, sys, zlib
+
+''' Compact binary project format, a lossless alternative to the JSON one
+
+The file starts with the magic b'SMPJ', a version word and a chunk count word, then the chunks.
+Each chunk has a 4 character tag, a flags byte (bit 0: zlib compressed), a length dword and its payload.
+All numbers are little endian.
+
+META: JSON object, the order of the project's keys and the values of the ones not stored in another chunk
+GFX : the graphics, raw
+PAL5: the palette as BGR555 words, if every color fits, otherwise
+PAL8: the palette as ARGB32 dwords
+SMAP: spritemap count dword, then for each one:
+      name length word, UTF-8 name, mode byte, body length dword, body
+      mode 0: the entries packed like in the ROM (5 bytes each, see encode_spritemap_entry())
+      mode 1: JSON of the whole spritemap, for ones that can't be packed without losing anything
+HBOX: JSON of the extended hitboxes
+ESPR: JSON of the extended spritemaps
+'''
+
+MAGIC = b'SMPJ'
+VERSION = 1
+BINARY_EXTENSION = '.smproj'
+
+_FLAG_COMPRESSED = 0x01
+_SPRITEMAP_PACKED = 0
+_SPRITEMAP_JSON = 1
+
+def _compact_json(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf8')
+
+def _color_to_bgr555(color):
+    '''Returns the BGR555 word for an ARGB32 color, or None if converting it back wouldn't give the same color'''
+    if not isinstance(color, int) or color & ~0xFFF8F8F8 != 0 or color >> 24 != 0xFF:
+        return None
+    return (color >> 19 & 0x1F) | (color >> 11 & 0x1F) << 5 | (color >> 3 & 0x1F) << 10
+
+def _bgr555_to_color(color555):
+    # same as extract_generic()
+    return 0xFF000000 | (color555 & 0x1F) << 19 | (color555 >> 5 & 0x1F) << 11 | (color555 >> 10 & 0x1F) << 3
+
+def _is_packable(spritemap):
+    if list(spritemap.keys()) != ['name', 'spritemap'] or not isinstance(spritemap['spritemap'], list):
+        return False
+    for entry in spritemap['spritemap']:
+        try:
+            decoded = decode_spritemap_entry(encode_spritemap_entry(entry))
+        except Exception:
+            return False
+        # compare the types too, True == 1 but JSON tells them apart
+        if list(entry.keys()) != list(decoded.keys()) or any(type(entry[key]) is not type(value) or entry[key] != value for key, value in decoded.items()):
+            return False
+    return True
+
+def _pack_spritemaps(spritemaps):
+    packed = bytearray(struct.pack('<I', len(spritemaps)))
+    for spritemap in spritemaps:
+        name = spritemap['name'].encode('utf8') if isinstance(spritemap.get('name'), str) else b''
+        if name and _is_packable(spritemap):
+            mode = _SPRITEMAP_PACKED
+            body = bytes(b for entry in spritemap['spritemap'] for b in encode_spritemap_entry(entry))
+        else:
+            # the name is still stored so the spritemap can be listed without parsing it
+            (mode, body) = (_SPRITEMAP_JSON, _compact_json(spritemap))
+        packed += struct.pack('<H', len(name)) + name + struct.pack('<BI', mode, len(body)) + body
+    return packed
+
+def index_spritemaps(chunk):
+    '''Returns (name, mode, body start, body end) for every spritemap in a SMAP chunk, without decoding the bodies'''
+    (count,) = struct.unpack_from('<I', chunk, 0)
+    offset = 4
+    index = []
+    for i in range(count):
+        (name_length,) = struct.unpack_from('<H', chunk, offset)
+        name = bytes(chunk[offset+2:offset+2+name_length]).decode('utf8')
+        offset += 2 + name_length
+        (mode, body_length) = struct.unpack_from('<BI', chunk, offset)
+        offset += 5
+        index.append((name, mode, offset, offset + body_length))
+        offset += body_length
+    return index
+
+def decode_spritemap(chunk, name, mode, start, end):
+    '''Decodes one spritemap of a SMAP chunk from its index entry'''
+    if mode == _SPRITEMAP_PACKED:
+        return {'name': name, 'spritemap': decode_spritemap_entries(chunk[start:end])}
+    return json.loads(bytes(chunk[start:end]))
+
+def decode_all_spritemaps(chunk):
+    '''Decodes every spritemap of a SMAP chunk, the packed entries all in one go'''
+    index = index_spritemaps(chunk)
+    packed = [(start, end) for name, mode, start, end in index if mode == _SPRITEMAP_PACKED]
+    entries = decode_spritemap_entries(b''.join(chunk[start:end] for start, end in packed))
+
+    spritemaps = []
+    position = 0
+    for name, mode, start, end in index:
+        if mode == _SPRITEMAP_PACKED:
+            count = (end - start) // 5
+            spritemaps.append({'name': name, 'spritemap': entries[position:position+count]})
+            position += count
+        else:
+            spritemaps.append(json.loads(bytes(chunk[start:end])))
+    return spritemaps
+
+class LazySpritemaps(Sequence):
+    '''The spritemaps of a SMAP chunk, indexed up front and each decoded the first time it's accessed'''
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.index = index_spritemaps(chunk)
+        self.decoded = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i not in self.decoded:
+            self.decoded[i] = decode_spritemap(self.chunk, *self.index[i])
+        return self.decoded[i]
+
+    def name(self, i):
+        return self.index[i][0]
+
+def save_binary_project(data, fp, compress=True):
+    chunks = []
+    meta = {'keys': list(data.keys()), 'values': {}}
+    for key, value in data.items():
+        if key == 'gfx' and isinstance(value, str) and str(base64.b64encode(base64.b64decode(value)), 'utf8') == value:
+            chunks.append((b'GFX ', base64.b64decode(value)))
+        elif key == 'palette' and isinstance(value, list) and all(isinstance(color, int) and 0 <= color <= 0xFFFFFFFF for color in value):
+            palette555 = [_color_to_bgr555(color) for color in value]
+            if None not in palette555:
+                chunks.append((b'PAL5', struct.pack(f'<{len(value)}H', *palette555)))
+            else:
+                chunks.append((b'PAL8', struct.pack(f'<{len(value)}I', *value)))
+        elif key == 'spritemaps' and isinstance(value, list):
+            chunks.append((b'SMAP', _pack_spritemaps(value)))
+        elif key == 'ext_hitboxes':
+            chunks.append((b'HBOX', _compact_json(value)))
+        elif key == 'ext_spritemaps':
+            chunks.append((b'ESPR', _compact_json(value)))
+        else:
+            meta['values'][key] = value
+    chunks.insert(0, (b'META', _compact_json(meta)))
+
+    with open(fp, 'wb') as file:
+        file.write(MAGIC + struct.pack('<HH', VERSION, len(chunks)))
+        for tag, payload in chunks:
+            flags = 0
+            if compress:
+                compressed = zlib.compress(payload)
+                if len(compressed) < len(payload):
+                    (payload, flags) = (compressed, _FLAG_COMPRESSED)
+            file.write(tag + struct.pack('<BI', flags, len(payload)))
+            file.write(payload)
+
+def read_binary_chunks(fp):
+    '''Returns the decompressed chunks of a binary project file by tag'''
+    with open(fp, 'rb') as file:
+        contents = file.read()
+    if contents[:4] != MAGIC:
+        raise AssertionError(f'{fp} is not a binary project file')
+    (version, chunk_count) = struct.unpack_from('<HH', contents, 4)
+    if version > VERSION:
+        raise AssertionError(f'{fp} was saved by a newer version (format version {version})')
+
+    chunks = {}
+    offset = 8
+    for i in range(chunk_count):
+        tag = contents[offset:offset+4]
+        (flags, length) = struct.unpack_from('<BI', contents, offset+4)
+        payload = memoryview(contents)[offset+9:offset+9+length]
+        chunks[tag] = zlib.decompress(payload) if flags & _FLAG_COMPRESSED else payload
+        offset += 9 + length
+    return chunks
+
+def load_binary_project(fp, lazy=False):
+    '''If lazy, the spritemaps are a LazySpritemaps instead of a list, so only the ones used get decoded'''
+    chunks = read_binary_chunks(fp)
+    meta = json.loads(bytes(chunks[b'META']))
+
+    data = {}
+    for key in meta['keys']:
+        if key in meta['values']:
+            data[key] = meta['values'][key]
+        elif key == 'gfx':
+            data[key] = str(base64.b64encode(chunks[b'GFX ']), 'utf8')
+        elif key == 'palette' and b'PAL5' in chunks:
+            data[key] = [_bgr555_to_color(color555) for (color555,) in struct.iter_unpack('<H', chunks[b'PAL5'])]
+        elif key == 'palette':
+            data[key] = [color for (color,) in struct.iter_unpack('<I', chunks[b'PAL8'])]
+        elif key == 'spritemaps':
+            data[key] = LazySpritemaps(chunks[b'SMAP']) if lazy else decode_all_spritemaps(chunks[b'SMAP'])
+        elif key == 'ext_hitboxes':
+            data[key] = json.loads(bytes(chunks[b'HBOX']))
+        elif key == 'ext_spritemaps':
+            data[key] = json.loads(bytes(chunks[b'ESPR']))
+    return data
+
+def is_binary_project(fp):
+    with open(fp, 'rb') as file:
+        return file.read(4) == MAGIC
+
+def load_project(fp, lazy=False):
+    '''Loads a project in either format, see load_binary_project() for lazy'''
+    if is_binary_project(fp):
+        return load_binary_project(fp, lazy)
+    with open(fp, 'r') as file:
+        return json.load(file)
+
+def save_project(data, fp):
+    '''Saves a project, in the binary format if the file name ends with BINARY_EXTENSION and as JSON otherwise'''
+    if fp.endswith(BINARY_EXTENSION):
+        save_binary_project(data, fp)
+    else:
+        if isinstance(data['spritemaps'], LazySpritemaps):
+            data = dict(data, spritemaps=list(data['spritemaps'])) # json can't write a Sequence
+        with open(fp, 'w') as file:
+            json.dump(data, file, indent=1)
+
+def convert_project(source, destination):
+    '''Converts a project file between JSON and the binary format, depending on the extension of destination'''
+    save_project(load_project(source), destination)
+
+def main():
+    if len(sys.argv) != 3:
+        print(f'usage: python -m src.project_file source destination\nconverts between JSON and binary ({BINARY_EXTENSION}) projects')
+        return
+    convert_project(sys.argv[1], sys.argv[2])
+
+if __name__ == '__main__':
+    main()
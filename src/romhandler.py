@@ -6,8 +6,10 @@
 #Note: it abstracts away little endian notation.  Just write into memory in big endian, and read out in big endian.
 #Taken from SpriteSomething (https://github.com/Artheau/SpriteSomething/blob/master/source/snes/romhandler.py)
 
+import bisect
 import enum
 import json
+import mmap
 import os
 import struct
 
@@ -20,7 +22,10 @@ class RomType(enum.Enum):
     EXHIROM = 0b101
 
 class RomHandlerParent():
-    def __init__(self, filename):
+    def __init__(self, filename, use_mmap=False):
+        #if use_mmap is set, the file is memory mapped instead of being read, and bulk_read() returns read-only views instead of copies
+        #writes go to a private copy-on-write mapping, so the file itself is never modified
+        #call close() (or use it in a with statement) to unmap the file once done
         #internal constants
         self._HEADER_SIZE = 0x200
         self._MEGABIT = 0x20000
@@ -40,10 +45,18 @@ class RomHandlerParent():
             raise AssertionError(f"{filename} does not contain an even number of half banks...is this a valid ROM?")
 
         #open the file and store the contents
+        self._mmap = None
         with open(filename, "rb") as file:
-            if self._rom_is_headered:
-                self._header = bytearray(file.read(self._HEADER_SIZE))
-            self._contents = bytearray(file.read())
+            if use_mmap:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+                contents = memoryview(self._mmap)
+                if self._rom_is_headered:
+                    self._header = bytearray(contents[:self._HEADER_SIZE])
+                self._contents = contents[self._HEADER_SIZE if self._rom_is_headered else 0:]
+            else:
+                if self._rom_is_headered:
+                    self._header = bytearray(file.read(self._HEADER_SIZE))
+                self._contents = bytearray(file.read())
 
         #Determine the type of ROM (e.g. LoRom or HiRom)
         #by comparing against checksum complement
@@ -79,6 +92,9 @@ class RomHandlerParent():
                 else:
                     self._type = RomType.HIROM
 
+        #now that the mapping is known, precompute the address conversion
+        self._build_bank_table()
+
         #check to make sure the makeup byte confirms our determination of the ROM type
         makeup_byte = self._read_from_internal_header(0x15, 1)
         if self._type == RomType.LOROM and makeup_byte in [0x20,0x30]:
@@ -103,6 +119,19 @@ class RomHandlerParent():
         #can also retrieve SRAM size if desired
         #self._SRAM_size = 0x400 << self._read_from_internal_header(0x18,1)
 
+    def close(self):
+        #unmaps the file if it is memory mapped.  The views returned by bulk_read() and get_view() must be released first.
+        if self._mmap is not None:
+            self._contents.release()
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def save(self, filename, overwrite=False,fix_checksum=True,strip_header=False):
         #check to see if a file by this name already exists
         if not overwrite and os.path.isfile(filename):
@@ -147,8 +176,17 @@ class RomHandlerParent():
 
     def bulk_read(self,addr,num_bytes):
         #for large reads, the read() function is too slow.  This returns the raw byte data.
+        #when memory mapped, this is a read-only view into the ROM instead of a copy: a later write() to those bytes changes it too,
+        #and it stops working once the ROM is closed, so copy it (e.g. with bytes()) to keep it
+        if self._mmap is not None:
+            return self._contents[addr:addr+num_bytes].toreadonly()
         return self._contents[addr:addr+num_bytes].copy()
 
+    def get_view(self):
+        #for reading through the whole ROM without copying it.  This returns a read-only memoryview of the contents.
+        #release it when done (e.g. with a with statement), the ROM can't be expanded while it is held
+        return memoryview(self._contents).toreadonly()
+
     def write(self,addr,values,encoding):
         #if encoding is an integer:
         #expects a value and an address to write to.  It will convert it to little-endian format automatically.
@@ -238,6 +276,123 @@ class RomHandlerParent():
 
     def convert_to_pc_address(self, addr):
         #takes as input an address in the SNES address space and maps it to the correct address in the PC ROM.
+        #this is a lookup in the table made by _build_bank_table(), it gives the same results as _convert_to_pc_address_reference()
+        if addr > 0xFFFFFF or addr < 0:
+                        # FIXME: English
+            raise AssertionError(f"Function convert_to_pc_address() called on {hex(addr)}, but this is outside SNES address space.")
+
+        base = self._bank_table[addr >> 16][addr >> 15 & 1]
+        if type(base) is tuple:     #a half bank that is mapped in pieces
+            (starts, bases) = base
+            base = bases[bisect.bisect_right(starts, addr & 0xFFFF) - 1]
+        if base is None:
+                        # FIXME: English
+            raise AssertionError(f"Function convert_to_pc_address() called on {hex(addr)}, but this does not map to ROM.")
+        return base + (addr & 0xFFFF)
+
+    def _build_bank_table(self):
+        #for every bank, and each half of it (below and from $8000), stores the PC address of offset $0000 in that bank,
+        #so that a conversion is just an addition.  Mirroring is already resolved and unmapped halves are None.
+        #the few halves that don't map in one piece (partially mirrored ones, or the $3E8000/$3F8000 quirk of ExHiRom)
+        #store a (first offsets, PC addresses of offset $0000) pair of tuples, one entry per piece
+        self._bank_table = []
+        for bank in range(0x100):
+            halves = []
+            for first_offset in (0x0000, 0x8000):
+                pieces = self._resolve_pieces(bank, first_offset, first_offset + 0x8000)
+                if len(pieces) == 1:
+                    halves.append(pieces[0][2])
+                else:
+                    halves.append((tuple(start for start, end, base in pieces), tuple(base for start, end, base in pieces)))
+            self._bank_table.append(tuple(halves))
+
+    def _unmirrored_pieces(self, bank):
+        #the mapping of a bank before mirroring, as (first offset, end offset, PC address of offset $0000 or None if unmapped)
+        #this follows the cases of _convert_to_pc_address_reference()
+        if self._type == RomType.LOROM:
+            low = (bank % 0x80)*0x8000 if bank >= 0x40 and bank < 0x70 else None    #MAD-1 area
+            high = (bank % 0x80)*0x8000 - 0x8000 if bank not in [0x7E, 0x7F] else None
+            return [(0x0000, 0x8000, low), (0x8000, 0x10000, high)]
+
+        elif self._type == RomType.HIROM:
+            base = (bank // 0x40)*0x10000 if bank not in [0x7E, 0x7F] else None
+            return [(0x0000, 0x8000, base if bank >= 0xC0 else None), (0x8000, 0x10000, base)]
+
+        elif self._type == RomType.EXLOROM:
+            if bank >= 0x80:            #fastrom block
+                high = (bank - 0x80)*0x8000 - 0x8000
+            elif bank not in [0x7E, 0x7F]:  #slowrom block
+                high = (bank + 0x80)*0x8000 - 0x8000
+            else:
+                high = None
+            low = high + 0x8000 if bank >= 0x40 and bank < 0x70 else None    #MAD-1 area
+            return [(0x0000, 0x8000, low), (0x8000, 0x10000, high)]
+
+        elif self._type == RomType.EXHIROM:
+            if bank >= 0xC0:                        #the fastrom block
+                return [(0x0000, 0x10000, (bank - 0xC0)*0x10000)]
+            elif bank >= 0x40 and bank < 0x7E:      #the slowrom block
+                return [(0x0000, 0x10000, bank*0x10000)]
+            elif bank in [0x3E, 0x3F]:              #the little bit of extra room at the end of the slowrom block, from $8001
+                return [(0x0000, 0x8001, None), (0x8001, 0x10000, (bank + 0x40)*0x10000)]
+            elif bank >= 0x80 and bank < 0xC0:      #the fastrom mirror
+                return [(0x0000, 0x8000, None), (0x8000, 0x10000, (bank - 0x80)*0x10000)]
+            elif bank < 0x3E:                       #the slowrom mirror
+                return [(0x0000, 0x8000, None), (0x8000, 0x10000, (bank + 0x40)*0x10000)]
+            return [(0x0000, 0x10000, None)]
+
+        raise NotImplementedError(f"Function convert_to_pc_address() called with not implemented type {self._type}")
+
+    def _resolve_pieces(self, bank, start, end):
+        #the mapping of offsets start to end of a bank, as (first offset, end offset, PC address of offset $0000 or None if unmapped)
+        #where the PC address is past the ROM, this resolves mirroring the same way as _convert_to_pc_address_reference():
+        #the most significant bit of the masked address is dropped, and the result is looked up again
+        mask = 0x7FFFFF if self._type == RomType.LOROM or self._type == RomType.EXLOROM else 0x3FFFFF
+        pieces = []
+        for (first, last, base) in self._unmirrored_pieces(bank):
+            first = max(first, start)
+            last = min(last, end)
+            if first >= last:
+                continue
+            if base is None:
+                pieces.append((first, last, None))
+                continue
+
+            #offsets up to the end of the ROM map directly (the end itself too, like in the reference)
+            mirror_start = min(max(self._rom_size - base + 1, first), last)
+            if first < mirror_start:
+                pieces.append((first, mirror_start, base))
+
+            offset = mirror_start
+            while offset < last:
+                most_significant_bit = (((bank << 16) + offset) & mask).bit_length() - 1
+                if most_significant_bit < 0:
+                    #the reference can't resolve this address either
+                    pieces.append((offset, offset + 1, None))
+                    offset += 1
+                elif most_significant_bit >= 16:
+                    #the same offsets of a lower bank
+                    pieces += self._resolve_pieces(bank - (1 << most_significant_bit - 16), offset, last)
+                    offset = last
+                else:
+                    #lower offsets of this bank, as long as the most significant bit stays the same
+                    step = 1 << most_significant_bit
+                    piece_end = min(last, step << 1)
+                    for (piece_first, piece_last, piece_base) in self._resolve_pieces(bank, offset - step, piece_end - step):
+                        pieces.append((piece_first + step, piece_last + step, piece_base - step if piece_base is not None else None))
+                    offset = piece_end
+
+        #join neighbouring pieces that map the same way
+        joined = [pieces[0]]
+        for piece in pieces[1:]:
+            if piece[2] == joined[-1][2]:
+                joined[-1] = (joined[-1][0], piece[1], piece[2])
+            else:
+                joined.append(piece)
+        return joined
+
+    def _convert_to_pc_address_reference(self, addr):
+        #the original conversion, kept to build the bank table and as a reference to check it against
         if addr > 0xFFFFFF or addr < 0:
                         # FIXME: English
             raise AssertionError(f"Function convert_to_pc_address() called on {hex(addr)}, but this is outside SNES address space.")
@@ -299,7 +454,7 @@ class RomHandlerParent():
 
             most_significant_bit = masked_addr.bit_length() - 1
             new_addr = addr - (1 << most_significant_bit)
-            pc_address = self.convert_to_pc_address(new_addr)    #recurse to get the corrected address
+            pc_address = self._convert_to_pc_address_reference(new_addr)    #recurse to get the corrected address
 
         return pc_address
 
@@ -322,9 +477,14 @@ class RomHandlerParent():
         self._write_to_internal_header(0x17, size_code, 1)
 
         pad_byte_amount = size*self._MEGABIT-self._rom_size
+        if self._mmap is not None:
+            contents = bytearray(self._contents)    #a mapping can't grow, so move the contents into memory for good
+            self.close()
+            self._contents = contents
         self._contents.extend([0]*pad_byte_amount)  #actually extend the ROM by padding with zeros
 
         self._rom_size = size*self._MEGABIT
+        self._build_bank_table()    #mirroring depends on the size
 
     def type(self):
         #to see if the rom is lorom, hirom, etc.
@@ -369,7 +529,7 @@ class RomHandlerParent():
             unpack_code = 'H'
         elif size == 3:
             unpack_code = 'L'
-            extracted_bytes.append(0x00)    #no native 3-byte unpacking format in Python; this is a workaround to pad the 4th byte
+            extracted_bytes = bytes(extracted_bytes) + b'\x00'    #no native 3-byte unpacking format in Python; this is a workaround to pad the 4th byte
         elif size == 4:
             unpack_code = 'L'
         else:
@@ -469,8 +629,48 @@ class FreeSpace():
             return self.get(size)
         raise AssertionError("ran out of memory to allocate")
 
+def _check_bank_table(rom_type, rom_size):
+    #compares convert_to_pc_address() with _convert_to_pc_address_reference() on every SNES address, returns the mismatches
+    rom = RomHandlerParent.__new__(RomHandlerParent)    #no ROM file needed, only the mapping
+    rom._type = rom_type
+    rom._rom_size = rom_size
+    rom._build_bank_table()
+
+    mismatches = []
+    for addr in range(0x1000000):
+        try:
+            expected = rom._convert_to_pc_address_reference(addr)
+        except (AssertionError, ValueError):    #ValueError: the reference can't mirror addresses whose masked part is 0
+            expected = None
+        try:
+            actual = rom.convert_to_pc_address(addr)
+        except AssertionError:
+            actual = None
+        if actual != expected:
+            mismatches.append((addr, expected, actual))
+    return mismatches
+
 def main():
-    print(f"Called main() on utility library {__file__}")
+    #checks the bank table against the reference conversion, for each mapper and a few ROM sizes (including ones that mirror)
+    #run with python -m src.romhandler, it takes a while
+    import time
+    sizes = {
+        RomType.LOROM: [0x80000, 0x300000],
+        RomType.HIROM: [0x180000, 0x400000],
+        RomType.EXLOROM: [0x600000],
+        RomType.EXHIROM: [0x500000, 0x7F0000],
+    }
+    failed = False
+    for rom_type, rom_sizes in sizes.items():
+        for rom_size in rom_sizes:
+            start = time.perf_counter()
+            mismatches = _check_bank_table(rom_type, rom_size)
+            print(f"{rom_type.name} {hex(rom_size)}: {len(mismatches)} mismatches in {time.perf_counter()-start:.1f} s")
+            for addr, expected, actual in mismatches[:10]:
+                print(f"  {hex(addr)}: {expected if expected is None else hex(expected)} expected, got {actual if actual is None else hex(actual)}")
+            failed = failed or len(mismatches) > 0
+    if failed:
+        raise AssertionError("the bank table doesn't match the reference conversion")
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,44 @@
-from PySide6.QtCore import Qt, QPointF, QRectF, Signal, Slot
+from PySide6.QtCore import Qt, QPointF, QRectF, QTimer, Signal, Slot
 from PySide6.QtGui import QIcon, QImage, QPen, QPixmap, QTransform
 from PySide6.QtWidgets import *
-from src.gfx import add_to_canvas_from_spritemap, to_qimage, convert_4bpp_to_image, convert_to_4bpp
+from src.gfx import TileCache, new_canvas, add_to_canvas_from_spritemap, to_qimage, convert_tiles_to_image, convert_to_4bpp
+from collections import OrderedDict
+from contextlib import contextmanager
 import base64, json, math
 
+class PixmapCache:
+    '''LRU cache of rendered sprite pixmaps (or index images), shared by all the sprites of the editor'''
+
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.pixmaps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        pixmap = self.pixmaps.get(key)
+        if pixmap != None:
+            self.pixmaps.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return pixmap
+
+    def put(self, key, pixmap):
+        self.pixmaps[key] = pixmap
+        self.pixmaps.move_to_end(key)
+        while len(self.pixmaps) > self.maxSize:
+            self.pixmaps.popitem(last=False)
+
+    def __len__(self):
+        return len(self.pixmaps)
+
+    def hitRate(self):
+        return self.hits/(self.hits+self.misses) if self.hits+self.misses > 0 else 0.0
+
+    def __str__(self):
+        return f'{len(self)}/{self.maxSize} pixmaps, {self.hits} hits, {self.misses} misses ({self.hitRate():.0%} hit rate)'
+
 class SpritePixmapItem(QGraphicsPixmapItem):
     def __init__(self, listItem, editor):
         super().__init__()
@@ -11,6 +46,7 @@ class SpritePixmapItem(QGraphicsPixmapItem):
 
         self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemIsMovable)
         self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemIsSelectable)
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemSendsGeometryChanges)
 
         self.listItem = listItem
         listItem.pixmapItem = self
@@ -19,22 +55,47 @@ class SpritePixmapItem(QGraphicsPixmapItem):
         self.setPos(self.spriteData['x'], self.spriteData['y'])
         self.updateImage()
 
-    def updateImage(self):
-        canvas = {}
-        add_to_canvas_from_spritemap(canvas, [{
-            'x': 0,
-            'y': 0,
-            'big': self.spriteData['big'],
-            'tile': self.spriteData['tile']-self.editor.data['gfx_offset'],
-            'palette': 0,
-            'bg_priority': self.spriteData['bg_priority'],
-            'h_flip': self.spriteData['h_flip'],
-            'v_flip': self.spriteData['v_flip']
-        }], self.editor.tiles)
-        image = to_qimage(canvas, self.editor.displayedPalettes[self.spriteData['palette']],
-            0, 0, 16 if self.spriteData['big'] else 8, 16 if self.spriteData['big'] else 8)
+    def itemChange(self, change, value):
+        if change == QGraphicsItem.GraphicsItemChange.ItemPositionChange:
+            # Snap tiles to nearest pixel
+            return QPointF(math.floor(value.x()+0.5), math.floor(value.y()+0.5))
+        if change == QGraphicsItem.GraphicsItemChange.ItemPositionHasChanged:
+            (x, y) = (int(value.x()), int(value.y()))
+            if self.spriteData['x'] != x or self.spriteData['y'] != y:
+                self.spriteData['x'] = x
+                self.spriteData['y'] = y
+                self.editor.spriteMoved(self)
+        return super().itemChange(change, value)
 
-        self.setPixmap(QPixmap.fromImage(image))
+    def updateImage(self):
+        tile = self.spriteData['tile']-self.editor.data['gfx_offset']
+        indexKey = (tile, self.spriteData['big'], self.spriteData['h_flip'], self.spriteData['v_flip'], self.editor.gfxGeneration)
+        key = indexKey + (self.spriteData['palette'], self.editor.paletteGeneration)
+        pixmap = self.editor.pixmapCache.get(key)
+        if pixmap == None:
+            # the tile's color indices (0-15) only get rendered once, palettes are just color tables on top
+            indices = self.editor.indexImageCache.get(indexKey)
+            if indices == None:
+                canvas = new_canvas()
+                add_to_canvas_from_spritemap(canvas, [{
+                    'x': 0,
+                    'y': 0,
+                    'big': self.spriteData['big'],
+                    'tile': tile,
+                    'palette': 0,
+                    'bg_priority': self.spriteData['bg_priority'],
+                    'h_flip': self.spriteData['h_flip'],
+                    'v_flip': self.spriteData['v_flip']
+                }], self.editor.tileCache)
+                indices = to_qimage(canvas, [0]*16, 0, 0, 16 if self.spriteData['big'] else 8, 16 if self.spriteData['big'] else 8)
+                self.editor.indexImageCache.put(indexKey, indices)
+
+            image = QImage(indices)
+            image.setColorTable(self.editor.displayedPalettes[self.spriteData['palette']])
+            pixmap = QPixmap.fromImage(image)
+            self.editor.pixmapCache.put(key, pixmap)
+
+        self.setPixmap(pixmap)
 
 class SpriteListItem(QListWidgetItem):
     def __init__(self, text, parent, data, editor):
@@ -54,17 +115,6 @@ class SpritemapScene(QGraphicsScene):
         painter.drawLine(rect.x()-2, 0, rect.x()+rect.width()+2, 0)
         painter.drawLine(0, rect.y()-2, 0, rect.y()+rect.height()+2)
 
-    def mouseMoveEvent(self, event):
-        # Snap tiles to nearest pixel
-        QGraphicsScene.mouseMoveEvent(self, event)
-        if self.mouseGrabberItem() != None:
-            for item in self.selectedItems():
-                item.setPos(math.floor(item.x()+0.5), math.floor(item.y()+0.5))
-                item.spriteData['x'] = int(item.x())
-                item.spriteData['y'] = int(item.y())
-
-            self.parent.updateCurrentSpriteChanged()
-
     def keyPressEvent(self, event):
         # Move items with arrow keys
         x = 0
@@ -82,11 +132,7 @@ class SpritemapScene(QGraphicsScene):
             y *= 8
         if x != 0 or y != 0:
             for item in self.selectedItems():
-                item.setPos(item.x()+x, item.y()+y)
-                item.spriteData['x'] = int(item.x())
-                item.spriteData['y'] = int(item.y())
-
-            self.parent.updateCurrentSpriteChanged()
+                item.moveBy(x, y) # SpritePixmapItem.itemChange updates the data
 
         # Copy
         if event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_C:
@@ -98,21 +144,7 @@ class SpritemapScene(QGraphicsScene):
 
         # Paste
         if event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_V:
-            pastedData = json.loads(QApplication.clipboard().text())
-            if len(pastedData) > 0:
-                for item in self.items():
-                    item.setSelected(False)
-
-                listSet = False
-                for tile in pastedData:
-                    item = SpriteListItem(str(self.parent.spriteList.count()), self.parent.spriteList, tile, self.parent)
-                    item.pixmapItem.setSelected(True)
-                    if not listSet:
-                        self.parent.spriteList.setCurrentItem(item)
-                        listSet = True
-
-                self.parent.updateSpritePixmapItemsZValues()
-                self.parent.updateData()
+            self.parent.pasteSprites(json.loads(QApplication.clipboard().text()))
 
         # Select all
         if event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_A:
@@ -121,13 +153,8 @@ class SpritemapScene(QGraphicsScene):
 
         # Delete selected
         if event.key() == Qt.Key_Delete:
-            for item in self.selectedItems():
-                self.removeItem(item)
-                self.parent.spriteList.takeItem(self.parent.spriteList.indexFromItem(item.listItem).row())
-
-            self.parent.updateSpritePixmapItemsZValues()
-            self.parent.fixSpriteListLabels()
-            self.parent.updateData()
+            spriteList = self.parent.spriteList
+            self.parent.removeSprites([i for i in range(spriteList.count()) if spriteList.item(i).pixmapItem.isSelected()])
 
 class SpritemapView(QGraphicsView):
     def __init__(self, scene, parent=None):
@@ -177,31 +204,86 @@ class SpriteList(QListWidget):
 
         # Paste
         if event.modifiers() == Qt.ControlModifier and event.key() == Qt.Key_V:
-            pastedData = json.loads(QApplication.clipboard().text())
-            if len(pastedData) > 0:
-                for item in self.parent.spritemapScene.items():
-                    item.setSelected(False)
-
-                listSet = False
-                for tile in pastedData:
-                    item = SpriteListItem(str(self.count()), self, tile, self.parent)
-                    item.pixmapItem.setSelected(True)
-                    if not listSet:
-                        self.setCurrentItem(item)
-                        listSet = True
-
-                self.parent.updateSpritePixmapItemsZValues()
-                self.parent.updateData()
+            self.parent.pasteSprites(json.loads(QApplication.clipboard().text()))
 
         # Delete
         if event.key() == Qt.Key_Delete:
             if self.currentItem() != None:
-                self.parent.spritemapScene.removeItem(self.currentItem().pixmapItem)
-                self.takeItem(self.indexFromItem(self.currentItem()).row())
+                self.parent.removeSprites([self.currentRow()])
 
-                self.parent.updateSpritePixmapItemsZValues()
-                self.parent.fixSpriteListLabels()
-                self.parent.updateData()
+class TileSheetItem(QGraphicsItem):
+    '''The sheet of tiles in the tile selector, 16 tiles wide
+
+    It's rendered in blocks of 16x16 tiles, only when they get visible. The blocks' color indices are kept as
+    indexed images, and the pixmaps made from them with each palette row's color table are cached.
+    '''
+    BLOCK_TILES = 0x100
+    BLOCK_HEIGHT = 0x80
+
+    def __init__(self):
+        super().__init__()
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption) # to get the exposed rect when painting
+
+        self.tiles = b''
+        self.tileCache = None
+        self.palettes = None
+        self.paletteGeneration = None
+        self.paletteRow = 0
+        self.blockImages = {} # block index: indexed image
+        self.blocks = {} # palette row: {block index: pixmap}
+
+    def setTiles(self, tiles, tileCache):
+        '''Only the blocks whose bytes changed will be rendered again'''
+        if tileCache is self.tileCache:
+            return
+        tiles = bytes(tiles)
+        blockSize = self.BLOCK_TILES*32
+        oldBlockCount = (len(self.tiles)+blockSize-1)//blockSize
+        for block in range(max(oldBlockCount, (len(tiles)+blockSize-1)//blockSize)):
+            if tiles[block*blockSize:(block+1)*blockSize] != self.tiles[block*blockSize:(block+1)*blockSize]:
+                self.blockImages.pop(block, None)
+                for rowBlocks in self.blocks.values():
+                    rowBlocks.pop(block, None)
+
+        if (len(tiles)//32+0xF)//0x10 != (len(self.tiles)//32+0xF)//0x10:
+            self.prepareGeometryChange()
+        self.tiles = tiles
+        self.tileCache = tileCache
+        self.update()
+
+    def setPalettes(self, palettes, generation, row):
+        '''palettes are the 8 palette rows, generation changes when their colors do'''
+        if generation != self.paletteGeneration:
+            self.blocks = {} # the indexed images are still good
+        self.palettes = palettes
+        self.paletteGeneration = generation
+        self.paletteRow = row
+        self.update()
+
+    def rowCount(self):
+        return (len(self.tiles)//32+0xF)//0x10
+
+    def boundingRect(self):
+        return QRectF(0, 0, 16*8, self.rowCount()*8)
+
+    def blockPixmap(self, block):
+        rowBlocks = self.blocks.setdefault(self.paletteRow, {})
+        if block not in rowBlocks:
+            if block not in self.blockImages:
+                self.blockImages[block] = convert_tiles_to_image(self.tileCache, [0]*16, block*self.BLOCK_TILES, self.BLOCK_TILES)
+            image = QImage(self.blockImages[block])
+            image.setColorTable(self.palettes[self.paletteRow])
+            rowBlocks[block] = QPixmap.fromImage(image)
+        return rowBlocks[block]
+
+    def paint(self, painter, option, widget=None):
+        if self.tileCache == None or self.palettes == None:
+            return
+        exposed = option.exposedRect
+        firstBlock = max(0, int(exposed.top())//self.BLOCK_HEIGHT)
+        lastBlock = min((self.rowCount()-1)//0x10, int(exposed.bottom())//self.BLOCK_HEIGHT)
+        for block in range(firstBlock, lastBlock+1):
+            painter.drawPixmap(0, block*self.BLOCK_HEIGHT, self.blockPixmap(block))
 
 class TileSelectorScene(QGraphicsScene):
     def __init__(self, parent):
@@ -281,8 +363,11 @@ class TileSelectorScene(QGraphicsScene):
             data['big'] = self.selection.rect().width() == 16
 
             self.parent.spriteList.currentItem().pixmapItem.updateImage()
+            self.parent.spritemapEdited()
 
 class SpritemapEditorWidget(QWidget):
+    edited = Signal(str) # 'spritemap' for the current spritemap, or an autosave section ('gfx', 'palette', 'meta')
+
     def __init__(self, parent, data: dict):
         super().__init__(parent)
         self.parent = parent
@@ -321,9 +406,8 @@ class SpritemapEditorWidget(QWidget):
         self.tileSelectorView.setSceneRect(0, 0, 16*8, 1*8)
         self.tileSelectorView.setFixedSize(16*8*3+6, 1*8*3+6)
         self.tileSelectorView.scale(3, 3)
-        self.tileSelectorImage = None
-        self.tileSelectorPixmap = QGraphicsPixmapItem()
-        self.tileSelectorScene.addItem(self.tileSelectorPixmap)
+        self.tileSheet = TileSheetItem()
+        self.tileSelectorScene.addItem(self.tileSheet)
 
         loadTilesButton = QPushButton('Load GFX')
         loadTilesButton.clicked.connect(self.loadTilesClicked)
@@ -391,22 +475,42 @@ class SpritemapEditorWidget(QWidget):
         layout.addWidget(self.spritemapView)
         layout.addLayout(rightSide)
 
+        self.pixmapCache = PixmapCache()
+        self.indexImageCache = PixmapCache()
+        self.batchDepth = 0
+
+        # moves of the sprites get handled at most once per frame
+        self.movedSprites = set()
+        self.moveTimer = QTimer(self)
+        self.moveTimer.setSingleShot(True)
+        self.moveTimer.setInterval(16)
+        self.moveTimer.timeout.connect(self.flushMovedSprites)
+        self.gfxGeneration = 0
+        self.paletteGeneration = 0
         self.loadData(data)
 
     def loadData(self, data):
         self.initialized = False
         self.data = data
-        self.frames = data['spritemaps']
+        self.loadTiles(bytearray(base64.b64decode(bytes(data['gfx'], 'utf8'))))
         self.loadPalettesFromData()
         self.gfxOffsetSpinBox.setValue(data['gfx_offset'])
         self.paletteOffsetSpinBox.setValue(data['palette_offset'])
 
+    def loadTiles(self, tiles):
+        '''Replaces the GFX, the tiles only get decoded here'''
+        self.tiles = tiles
+        self.tileCache = TileCache(tiles)
+        self.gfxGeneration += 1 # pixmaps rendered from the old GFX won't be used anymore
+
     def loadPalettesFromData(self):
+        self.paletteGeneration += 1
         self.displayedPalettes = []
         for i in range(self.data['palette_offset']):
             self.displayedPalettes.append([0]+[0xFF000000]*16)
         for i in range(0, len(self.data['palette']), 16):
-            self.displayedPalettes.append([0]+self.data['palette'][i+1:i+16])
+            palette = [0]+self.data['palette'][i+1:i+16]
+            self.displayedPalettes.append(palette+[0]*(16-len(palette))) # used as color tables, missing colors are transparent
         for i in range(8-len(self.displayedPalettes)):
             self.displayedPalettes.append([0]+[0xFF000000]*16)
 
@@ -414,6 +518,10 @@ class SpritemapEditorWidget(QWidget):
         self.currentSpritemapData['spritemap'] = []
         for i in range(self.spriteList.count()):
             self.currentSpritemapData['spritemap'].append(self.spriteList.item(i).spriteData)
+        self.spritemapEdited()
+
+    def spritemapEdited(self):
+        self.edited.emit('spritemap')
 
     def updateSpritemapChanged(self, spritemapData):
         self.initialized = False
@@ -424,8 +532,6 @@ class SpritemapEditorWidget(QWidget):
         self.tileSelectorPaletteSpinBox.setValue(self.data['palette_offset'])
         self.spritePropertiesFormBox.setEnabled(False)
 
-        self.tiles = bytearray(base64.b64decode(bytes(self.data['gfx'], 'utf8')))
-
         # Add tiles to the sprite tile list and the spritemap scene
         for i in range(len(self.currentSpritemapData['spritemap'])):
             SpriteListItem(str(i), self.spriteList, self.currentSpritemapData['spritemap'][i], self)
@@ -437,9 +543,60 @@ class SpritemapEditorWidget(QWidget):
 
         self.initialized = True
 
+    @contextmanager
+    def batchEdit(self):
+        '''Groups edits of the sprites: the scene index and the list's signals are suspended meanwhile,
+        then the z-values, labels and spritemap data get updated once at the end'''
+        self.batchDepth += 1
+        if self.batchDepth == 1:
+            self.spritemapScene.setItemIndexMethod(QGraphicsScene.NoIndex)
+            self.spriteList.blockSignals(True)
+        try:
+            yield
+        finally:
+            self.batchDepth -= 1
+            if self.batchDepth == 0:
+                self.spriteList.blockSignals(False)
+                self.spritemapScene.setItemIndexMethod(QGraphicsScene.BspTreeIndex)
+                self.updateSpritePixmapItemsZValues()
+                self.fixSpriteListLabels()
+                self.updateData()
+                self.updateCurrentSpriteChanged() # currentItemChanged was blocked
+
+    def spriteMoved(self, pixmapItem):
+        self.movedSprites.add(pixmapItem)
+        if not self.moveTimer.isActive():
+            self.moveTimer.start()
+
+    @Slot()
+    def flushMovedSprites(self):
+        if len(self.movedSprites) > 0:
+            currentItem = self.spriteList.currentItem()
+            if currentItem != None and currentItem.pixmapItem in self.movedSprites:
+                self.updateCurrentSpriteChanged()
+            self.movedSprites.clear()
+            self.spritemapEdited()
+
+    def pasteSprites(self, sprites):
+        '''Adds sprites at the end and selects them'''
+        if len(sprites) > 0:
+            with self.batchEdit():
+                self.spritemapScene.clearSelection()
+                for i, sprite in enumerate(sprites):
+                    item = SpriteListItem(str(self.spriteList.count()), self.spriteList, sprite, self)
+                    item.pixmapItem.setSelected(True)
+                    if i == 0:
+                        self.spriteList.setCurrentItem(item)
+
+    def removeSprites(self, rows):
+        with self.batchEdit():
+            for row in sorted(rows, reverse=True): # from the end so the other rows don't shift
+                item = self.spriteList.takeItem(row)
+                self.spritemapScene.removeItem(item.pixmapItem)
+
     @Slot()
     def spritemapSceneSelectionChanged(self):
-        if self.initialized: # needed to not throw an error when switching to a different spritemap with items selected
+        if self.initialized and self.batchDepth == 0: # needed to not throw an error when switching to a different spritemap with items selected
             for i in range(self.spriteList.count()):
                 item = self.spriteList.item(i)
                 if item.pixmapItem.isSelected():
@@ -463,15 +620,9 @@ class SpritemapEditorWidget(QWidget):
 
     @Slot()
     def deleteClicked(self):
-        for item in self.spriteList.selectedItems():
-            if item is self.spriteList.currentItem():
-                self.spriteList.setCurrentItem(None)
-            self.spriteList.takeItem(self.spriteList.indexFromItem(item).row())
-            self.spritemapScene.removeItem(item.pixmapItem)
-
-        self.updateSpritePixmapItemsZValues()
-        self.fixSpriteListLabels()
-        self.updateData()
+        if self.spriteList.currentItem() != None and self.spriteList.currentItem().isSelected():
+            self.spriteList.setCurrentItem(None)
+        self.removeSprites([i for i in range(self.spriteList.count()) if self.spriteList.item(i).isSelected()])
 
     @Slot()
     def moveUpClicked(self):
@@ -479,13 +630,10 @@ class SpritemapEditorWidget(QWidget):
         if item != None:
             index = self.spriteList.indexFromItem(item).row()
             if index > 0:
-                self.spriteList.takeItem(index)
-                self.spriteList.insertItem(index-1, item)
-                self.spriteList.setCurrentItem(item)
-               
-                self.updateSpritePixmapItemsZValues()
-                self.fixSpriteListLabels()
-                self.updateData()
+                with self.batchEdit():
+                    self.spriteList.takeItem(index)
+                    self.spriteList.insertItem(index-1, item)
+                    self.spriteList.setCurrentItem(item)
 
     @Slot()
     def moveDownClicked(self):
@@ -493,13 +641,10 @@ class SpritemapEditorWidget(QWidget):
         if item != None:
             index = self.spriteList.indexFromItem(item).row()
             if index < self.spriteList.count()-1:
-                self.spriteList.takeItem(index)
-                self.spriteList.insertItem(index+1, item)
-                self.spriteList.setCurrentItem(item)
-               
-                self.updateSpritePixmapItemsZValues()
-                self.fixSpriteListLabels()
-                self.updateData()
+                with self.batchEdit():
+                    self.spriteList.takeItem(index)
+                    self.spriteList.insertItem(index+1, item)
+                    self.spriteList.setCurrentItem(item)
 
     @Slot(SpriteListItem)
     def spriteListSelectItem(self, item):
@@ -522,34 +667,36 @@ class SpritemapEditorWidget(QWidget):
     def updateTileSelector(self):
         tileCount = len(self.tiles)//32
 
-        self.tileSelectorImage = convert_4bpp_to_image(self.tiles, self.data['palette'])
-        self.tileSelectorPixmap.setPixmap(QPixmap.fromImage(self.tileSelectorImage))
+        # cheap if nothing changed, the sheet only renders what's visible and changed
+        self.tileSheet.setTiles(self.tiles, self.tileCache)
+        self.tileSheet.setPalettes(self.displayedPalettes, self.paletteGeneration, self.tileSelectorPaletteSpinBox.value())
         self.tileSelectorView.setSceneRect(0, 0, 16*8, (tileCount-1)//16*8+8)
         self.tileSelectorView.setMaximumHeight(((tileCount-1)//16*8+8)*3+6)
 
     @Slot()
     def loadTilesClicked(self):
-        if self.tileSelectorImage != None:
-            fileName = QFileDialog.getOpenFileName(self, filter='PNG files (*.png)')[0]
-            if fileName != '':
-                image = QImage(fileName)
-                self.tiles = convert_to_4bpp(image)
-                self.data['gfx'] = str(base64.b64encode(self.tiles), 'utf8')
-                self.data['palette'] = image.colorTable()
-
-                self.loadPalettesFromData()
-                self.updateTileSelector()
+        fileName = QFileDialog.getOpenFileName(self, filter='PNG files (*.png)')[0]
+        if fileName != '':
+            image = QImage(fileName)
+            self.loadTiles(convert_to_4bpp(image))
+            self.data['gfx'] = str(base64.b64encode(self.tiles), 'utf8')
+            self.data['palette'] = image.colorTable()
+
+            self.loadPalettesFromData()
+            self.updateTileSelector()
+            self.edited.emit('gfx')
+            self.edited.emit('palette')
 
-                # update all sprites in the spritemap scene
-                for item in self.spritemapScene.items():
-                    item.updateImage()
+            # update all sprites in the spritemap scene
+            for item in self.spritemapScene.items():
+                item.updateImage()
 
     @Slot()
     def saveTilesClicked(self):
-        if self.tileSelectorImage != None:
-            fileName = QFileDialog.getSaveFileName(self, filter='PNG files (*.png)')[0]
-            if fileName != '':
-                self.tileSelectorImage.save(fileName)
+        fileName = QFileDialog.getSaveFileName(self, filter='PNG files (*.png)')[0]
+        if fileName != '':
+            # the whole sheet with the whole palette, so it can be loaded back
+            convert_tiles_to_image(self.tileCache, self.data['palette']).save(fileName)
 
     @Slot()
     def updateCurrentSpriteChanged(self):
@@ -557,24 +704,35 @@ class SpritemapEditorWidget(QWidget):
         if self.spriteList.currentItem() != None:
             self.spritePropertiesFormBox.setEnabled(True)
             data = self.spriteList.currentItem().spriteData
-            self.xSpinBox.setValue(data['x']) # xSpinBoxChanged gets activated, but this isn't a problem
+
+            # only show the values, the changed signals are for edits by the user
+            widgets = (self.xSpinBox, self.ySpinBox, self.paletteSpinBox, self.prioritySpinBox, self.hFlipCheckBox, self.vFlipCheckBox)
+            for widget in widgets:
+                widget.blockSignals(True)
+            self.xSpinBox.setValue(data['x'])
             self.ySpinBox.setValue(data['y'])
             self.paletteSpinBox.setValue(data['palette'])
             self.prioritySpinBox.setValue(data['bg_priority'])
             self.hFlipCheckBox.setCheckState(Qt.Checked if data['h_flip'] else Qt.Unchecked)
             self.vFlipCheckBox.setCheckState(Qt.Checked if data['v_flip'] else Qt.Unchecked)
+            for widget in widgets:
+                widget.blockSignals(False)
         else:
             self.spritePropertiesFormBox.setEnabled(False)
 
     @Slot(int)
     def gfxOffsetSpinBoxChanged(self, offset):
-        self.data['gfx_offset'] = offset
+        if self.data['gfx_offset'] != offset:
+            self.data['gfx_offset'] = offset
+            self.edited.emit('meta')
         for item in self.spritemapScene.items():
             item.updateImage()
 
     @Slot(int)
     def paletteOffsetSpinBoxChanged(self, offset):
-        self.data['palette_offset'] = offset
+        if self.data['palette_offset'] != offset:
+            self.data['palette_offset'] = offset
+            self.edited.emit('meta')
         self.loadPalettesFromData()
         for item in self.spritemapScene.items():
             item.updateImage()
@@ -592,6 +750,7 @@ class SpritemapEditorWidget(QWidget):
             if data['x'] != x: # check if the value actually changed
                 data['x'] = x
                 self.spriteList.currentItem().pixmapItem.setX(x)
+                self.spritemapEdited()
 
     @Slot(int)
     def ySpinBoxChanged(self, y):
@@ -600,6 +759,7 @@ class SpritemapEditorWidget(QWidget):
             if data['y'] != y:
                 data['y'] = y
                 self.spriteList.currentItem().pixmapItem.setY(y)
+                self.spritemapEdited()
 
     @Slot(int)
     def paletteSpinBoxChanged(self, palette):
@@ -608,12 +768,15 @@ class SpritemapEditorWidget(QWidget):
             if data['palette'] != palette:
                 data['palette'] = palette
                 self.spriteList.currentItem().pixmapItem.updateImage()
+                self.spritemapEdited()
 
     @Slot(int)
     def prioritySpinBoxChanged(self, priority):
         if self.spriteList.currentItem() != None:
             data = self.spriteList.currentItem().spriteData
-            data['bg_priority'] = priority
+            if data['bg_priority'] != priority:
+                data['bg_priority'] = priority
+                self.spritemapEdited()
 
     @Slot(Qt.CheckState)
     def hFlipCheckBoxChanged(self, state):
@@ -623,6 +786,7 @@ class SpritemapEditorWidget(QWidget):
             if data['h_flip'] != checked:
                 data['h_flip'] = checked
                 self.spriteList.currentItem().pixmapItem.updateImage()
+                self.spritemapEdited()
 
     @Slot(Qt.CheckState)
     def vFlipCheckBoxChanged(self, state):
@@ -632,6 +796,7 @@ class SpritemapEditorWidget(QWidget):
             if data['v_flip'] != checked:
                 data['v_flip'] = checked
                 self.spriteList.currentItem().pixmapItem.updateImage()
+                self.spritemapEdited()
 
     def hFlip(self):
         toflip = self.spritemapScene.selectedItems()
@@ -643,6 +808,7 @@ class SpritemapEditorWidget(QWidget):
             data['x'] = -data['x']-(16 if data['big'] else 8)
             item.setX(data['x'])
             item.updateImage()
+        self.spritemapEdited()
 
     def vFlip(self):
         toflip = self.spritemapScene.selectedItems()
@@ -654,3 +820,4 @@ class SpritemapEditorWidget(QWidget):
             data['y'] = -data['y']-(16 if data['big'] else 8)
             item.setY(data['y'])
             item.updateImage()
+        self.spritemapEdited()